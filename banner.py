@@ -0,0 +1,52 @@
+"""
+The banner, scaled once to the exact box it fills in the header
+
+The browser would otherwise decode the full banner and resample it into the
+header on every render. Instead it is resized here the way object-fit: cover
+would, written as a quickly compressed PNG under output/cache/banner named by
+the source's hash, and only redone when the banner itself changes.
+"""
+import hashlib
+import os
+
+import cv2
+
+from cache import CACHE_DIR, keep_newest, replacing
+
+BANNER_CACHE = CACHE_DIR + "/banner"
+# .header in style.css: 2048 - 44 - (28 + 96 + 44) wide, 916 high
+HEADER_SIZE = (1836, 916)
+PNG_FAST = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+BANNERS_KEEP = 2
+
+
+def scale_to_cover(image, width, height):
+    """Scale image to cover width x height, cropping the overflow evenly from both sides"""
+    in_h, in_w = image.shape[:2]
+    scale = max(width / in_w, height / in_h)
+    scaled_w, scaled_h = max(width, round(in_w * scale)), max(height, round(in_h * scale))
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    scaled = cv2.resize(image, (scaled_w, scaled_h), interpolation=interpolation)
+    x0, y0 = (scaled_w - width) // 2, (scaled_h - height) // 2
+    return scaled[y0:y0 + height, x0:x0 + width]
+
+
+def ingest_banner(banner_path, size=HEADER_SIZE):
+    """Path of banner_path scaled to size, made whenever its contents change; the original if unreadable"""
+    try:
+        with open(banner_path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    except OSError:
+        return banner_path
+    out_path = f"{BANNER_CACHE}/banner-{digest}-{size[0]}x{size[1]}.png"
+    if os.path.exists(out_path):
+        os.utime(out_path)
+        return out_path
+
+    image = cv2.imread(banner_path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        return banner_path
+    with replacing(out_path) as tmp_path:
+        cv2.imwrite(tmp_path, scale_to_cover(image, *size), PNG_FAST)
+    keep_newest(f"{BANNER_CACHE}/banner-*.png", BANNERS_KEEP)
+    return out_path
@@ -0,0 +1,159 @@
+"""
+On-disk caches kept between runs, under output/cache
+"""
+import glob
+import hashlib
+import os
+import pickle
+from contextlib import contextmanager
+from datetime import timezone
+
+from ics import expand_event, in_window, make_event, read_event_defs, recur_window_start
+
+CACHE_DIR = "output/cache"
+EXPANSION_CACHE = CACHE_DIR + "/expansion.pickle"
+# Bump when what the readers return changes, so old files are ignored
+DEFS_FORMAT = 2  # 2: the streaming reader resolves TZIDs from VTIMEZONEs
+DEFS_KEEP = 8  # parsed calendars kept around, most recently used first
+
+
+@contextmanager
+def replacing(path):
+    """
+    A temporary path beside path, with its extension, to write path's new contents to.
+    Renamed over path once the block completes, and removed if it doesn't, so a
+    concurrent reader never sees half a file. Hidden, so keep_newest never matches it.
+    """
+    directory, name = os.path.split(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    stem, extension = os.path.splitext(name)
+    tmp_path = os.path.join(directory, f".{stem}.{os.getpid()}.tmp{extension}")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def keep_newest(pattern, keep):
+    """Remove all but the keep most recently modified files matching pattern; touch a file to keep it"""
+    for old_path in sorted(glob.glob(pattern), key=os.path.getmtime, reverse=True)[keep:]:
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+
+
+def write_pickle(path, obj):
+    with replacing(path) as tmp_path, open(tmp_path, "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_pickle(path, default=None):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+        return default
+
+
+def _defs_path(raw, reader, with_details):
+    variant = reader.__name__ + ('-details' if with_details else '')
+    return f"{CACHE_DIR}/defs-v{DEFS_FORMAT}-{hashlib.sha256(raw).hexdigest()}-{variant}.pickle"
+
+
+def cached_event_defs(raw, reader=read_event_defs, with_details=True):
+    """Definitions previously stored for these exact bytes, or None"""
+    path = _defs_path(raw, reader, with_details)
+    defs = read_pickle(path)
+    if defs is not None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+    return defs
+
+
+def store_event_defs(raw, reader, with_details, defs):
+    write_pickle(_defs_path(raw, reader, with_details), defs)
+    keep_newest(f"{CACHE_DIR}/defs-*.pickle", DEFS_KEEP)
+
+
+def load_event_defs(raw, reader=read_event_defs, with_details=True):
+    """
+    reader(raw, with_details) memoized on disk by the SHA-256 of the raw calendar.
+    A hit skips parsing entirely, and is safe to share between processes.
+    raw may be a str or anything exposing bytes, such as an mmap.
+    """
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8')
+    defs = cached_event_defs(raw, reader, with_details)
+    if defs is None:
+        defs = list(reader(raw, with_details))
+        store_event_defs(raw, reader, with_details, defs)
+    return defs
+
+
+def event_fingerprint(defn):
+    """(key, fingerprint) of a definition, or None if it can't be told apart from other revisions"""
+    if not defn['uid'] or (not defn['sequence'] and not defn['modified']):
+        return None
+    return (defn['uid'], defn['recurrence_id']), (defn['sequence'], defn['modified'])
+
+
+class ExpansionCache:
+    """
+    Occurrences of every recurring event from the last run, with the window they cover.
+
+    When the new window has only slid forward, an unchanged event (same UID,
+    SEQUENCE and LAST-MODIFIED) keeps its cached occurrences minus the ones that
+    fell off the front, and only the newly exposed tail is expanded. Changed or
+    new events are expanded in full; events gone from the feed are forgotten.
+    """
+
+    def __init__(self, path=EXPANSION_CACHE):
+        self.path = path
+        self.window, self.entries = read_pickle(path, (None, {}))
+
+    def can_slide_to(self, window_start, window_end, local_tz):
+        if self.window is None:
+            return False
+        prev_start, prev_end, prev_tz = self.window
+        return prev_tz == local_tz and prev_start <= window_start <= prev_end <= window_end
+
+    def expand(self, defs, window_start, window_end, local_tz=timezone.utc):
+        """Drop-in for ics.expand_events that reuses the previous run's expansion"""
+        sliding = self.can_slide_to(window_start, window_end, local_tz)
+        prev_end = self.window[1] if sliding else None
+        entries = {}
+        events = []
+        for defn in defs:
+            ident = event_fingerprint(defn) if defn['rrule'] else None
+            if ident is None or ident[0] in entries:
+                events.extend(expand_event(defn, window_start, window_end, local_tz))
+                continue
+            key, fingerprint = ident
+
+            cached = self.entries.get(key)
+            if sliding and cached and cached[0] == fingerprint:
+                recur_win_start = recur_window_start(window_start, defn['allday'], local_tz)
+                spans = [(s, e) for s, e in cached[1] if s >= recur_win_start and
+                         in_window({'startdt': s, 'enddt': e}, window_start, window_end)]
+                spans.extend((e['startdt'], e['enddt'])
+                             for e in expand_event(defn, prev_end, window_end, local_tz)
+                             if e['startdt'] > prev_end)
+            else:
+                spans = [(e['startdt'], e['enddt'])
+                         for e in expand_event(defn, window_start, window_end, local_tz)]
+
+            entries[key] = (fingerprint, spans)
+            events.extend(make_event(defn, s, e, True) for s, e in spans)
+
+        self.window = (window_start, window_end, local_tz)
+        self.entries = entries
+        return events
+
+    def save(self):
+        write_pickle(self.path, (self.window, self.entries))
@@ -0,0 +1,52 @@
+"""
+Which outputs look as they did when last published
+
+The footer's "Generated" time changes every run, so no two runs' images are
+byte-identical even when no event moved. Each output instead gets a signature:
+the mean colour of every BLOCK x BLOCK block, with the blocks under volatile
+regions such as that timestamp blanked out. It is compared with the signature
+saved under output/cache/published when the output was last published; the
+file's modification time is when that was, for republishing once it's stale.
+"""
+import os
+import time
+
+import cv2
+import numpy as np
+
+from cache import CACHE_DIR, replacing
+
+PUBLISHED_DIR = CACHE_DIR + "/published"
+BLOCK = 16
+TOLERANCE = 2  # levels a block's mean may drift, e.g. with antialiasing, and still count as unchanged
+
+
+def signature(image, regions=(), full_size=None):
+    """
+    Block means of image, zero in every block touching one of regions, (x, y, w, h)
+    in the pixels of a full_size square image of which image is a scaled copy
+    """
+    height, width = image.shape[:2]
+    means = cv2.resize(image, (width // BLOCK, height // BLOCK), interpolation=cv2.INTER_AREA)
+    scale = width / (full_size or width) / BLOCK
+    for x, y, w, h in regions:
+        means[int(y * scale):int(np.ceil((y + h) * scale)), int(x * scale):int(np.ceil((x + w) * scale))] = 0
+    return means
+
+
+def is_unchanged(name, image_signature, max_age):
+    """Whether output 'name' was published less than max_age (a timedelta) ago and looked the same"""
+    path = f"{PUBLISHED_DIR}/{name}.npy"
+    try:
+        age = time.time() - os.path.getmtime(path)
+        published = np.load(path)
+    except (OSError, ValueError):
+        return False
+    if age > max_age.total_seconds() or published.shape != image_signature.shape:
+        return False
+    return int(np.abs(published.astype(np.int16) - image_signature).max()) <= TOLERANCE
+
+
+def record_published(name, image_signature):
+    with replacing(f"{PUBLISHED_DIR}/{name}.npy") as tmp_path:
+        np.save(tmp_path, image_signature)
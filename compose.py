@@ -0,0 +1,138 @@
+"""
+Compositing of the per-offset pieces onto renders shared between offsets
+
+Offsets whose calendars come out identical are rendered once; each of them then
+only differs by its footer labels. Those are rendered for all such offsets at
+once, one footer per tile of a label strip, and pasted over a copy of the shared
+frame. The footers are found by their border colour, so nothing here depends on
+the exact page geometry beyond the .labels box in style.css.
+
+When compositing, the chrome (banner, spacer and footer, the top CHROME_HEIGHT
+rows of every page) is rendered once per run, and each offset only renders its
+calendar body; the two are stacked while folding, and every offset is labelled.
+
+Pages may be rendered only as tall as their content; folding pads them back
+to the full square by repeating their last, blank, row.
+
+In an atlas, several offsets' pages are panels of one document taken in one
+screenshot, and each is sliced back out as a view of it.
+"""
+from string import Template
+
+import numpy as np
+
+LABELS_TEMPLATE = "html-resources/template/labels.html"
+LABEL_TILE = Template('<div class="footer"><div class="labels">UTC$timezone<br/>Generated $now</div></div>')
+LABEL_TILE_HEIGHT = 122  # .footer's 120px plus its border
+PAGE_SIZE = (2048, 8192)
+# .top and the collapsed top margin of .bottom end exactly here, see style.css
+CHROME_HEIGHT = 2048
+BODY_HEIGHT = PAGE_SIZE[1] - CHROME_HEIGHT
+FOOTER_BORDER = (0xA1, 0xA1, 0x5F)  # #5FA1A1, as BGR
+MIN_BORDER_RUN = 1000  # pixels of border colour in a row for it to count as a footer edge
+# The .labels box, relative to the footer's padding box
+LABELS_TOP = 8
+LABELS_RIGHT = 136
+LABELS_WIDTH = 480
+LABELS_HEIGHT = 104
+
+
+def label_strip_html(labels):
+    """A page of footers, one per (timezone, now) pair in labels, stacked in order"""
+    with open(LABELS_TEMPLATE, "r", encoding="utf-8") as f:
+        strip_template = Template(f.read())
+    tiles = '\n'.join(LABEL_TILE.substitute(timezone=timezone, now=now) for timezone, now in labels)
+    return strip_template.substitute(tiles=tiles)
+
+
+def footer_edges(image):
+    """(top row, left column, right column) of every footer in the image, top to bottom"""
+    border = np.all(image == FOOTER_BORDER, axis=2)
+    rows = np.flatnonzero(np.count_nonzero(border, axis=1) >= MIN_BORDER_RUN)
+    edges = []
+    # Top and bottom borders alternate, even where tiles touch
+    for top in rows[::2].tolist():
+        columns = np.flatnonzero(border[top])
+        edges.append((top, int(columns[0]), int(columns[-1])))
+    return edges
+
+
+def labels_box(image, index=0):
+    """(y0, y1, x0, x1) of the labels of the index-th footer in the image, or None"""
+    edges = footer_edges(image)
+    if index >= len(edges):
+        return None
+    top, _, right = edges[index]
+    y0 = top + 1 + LABELS_TOP
+    x1 = right - LABELS_RIGHT
+    return y0, y0 + LABELS_HEIGHT, x1 - LABELS_WIDTH, x1
+
+
+def paste_labels(frame, strip, index):
+    """
+    Replace the labels in frame, in place, with those of tile 'index' of a rendered strip.
+    Works on the folded frame too, as the footer sits in the untouched left half.
+    Returns False if either footer can't be found.
+    """
+    box = labels_box(frame)
+    tile = labels_box(strip, index)
+    if box is None or tile is None:
+        return False
+    y0, y1, x0, x1 = box
+    ty0, ty1, tx0, tx1 = tile
+    frame[y0:y1, x0:x1] = strip[ty0:ty1, tx0:tx1]
+    return True
+
+
+def _fill_rows(dst, src):
+    """Copy src to the top of dst, repeating src's last row below it"""
+    rows = min(len(src), len(dst))
+    dst[:rows] = src[:rows]
+    dst[rows:] = src[-1:]
+
+
+def _square(width, out):
+    if out is None or out.shape != (2 * width, 2 * width, 3):
+        return np.empty((2 * width, 2 * width, 3), dtype=np.uint8)
+    return out
+
+
+def fold_page(image, out=None):
+    """
+    A page screenshot folded into a square: its top half on the left, the rest on
+    the right. A page rendered shorter than PAGE_SIZE is padded with its last
+    row, which holds only the background and scrollbar. Written into out if it
+    is the right size, so one buffer can be reused across pages.
+    """
+    width = image.shape[1]
+    folded = _square(width, out)
+    _fill_rows(folded[:, :width], image[:2 * width])
+    _fill_rows(folded[:, width:], image[2 * width:] if len(image) > 2 * width else image[-1:])
+    return folded
+
+
+def composite_fold(chrome, body, out=None):
+    """
+    The page of chrome over body, folded into a square the way fold_page folds
+    a full screenshot, written straight into the result (out, if given). body may be short.
+    """
+    width = chrome.shape[1]
+    left_body = 2 * width - CHROME_HEIGHT  # rows of body under the chrome in the left half
+    folded = _square(width, out)
+    folded[:CHROME_HEIGHT, :width] = chrome[:CHROME_HEIGHT]
+    _fill_rows(folded[CHROME_HEIGHT:, :width], body[:left_body])
+    _fill_rows(folded[:, width:], body[left_body:left_body + 2 * width] if len(body) > left_body else body[-1:])
+    return folded
+
+
+def bottom_is_blank(image, scrollbar_x=1956):
+    """Whether the last row holds only the background and the scrollbar, i.e. nothing was cut off"""
+    row = image[-1]
+    background, scrollbar = row[0], row[scrollbar_x]
+    return bool(np.all(np.all(row == background, axis=1) | np.all(row == scrollbar, axis=1)))
+
+
+def atlas_panel(atlas, index, columns, height, width=PAGE_SIZE[0]):
+    """View of panel 'index' of an atlas screenshot with panels laid out in rows of 'columns'; no copy"""
+    row, column = divmod(index, columns)
+    return atlas[row * height:(row + 1) * height, column * width:(column + 1) * width]
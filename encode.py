@@ -0,0 +1,267 @@
+"""
+Encoding of the folded calendars into the MP4s Unity plays, and a benchmark of the ways to do it
+
+Each video is one still image. Unity's VideoPlayer takes H.264 in yuv420p on
+every platform, so all the profiles keep to that and differ only in how hard
+x264 works: fastest, balanced and smallest. They all use x264's still-image
+tuning and two one-second frames, a keyframe and a repeat of it that costs
+almost nothing, read from the image once per frame. The original settings
+('legacy') encoded four frames and decoded the PNG fifty times for them.
+Several images can also go into one video, a keyframe each, for players to seek in.
+
+Besides MP4, the images can be written as WebP (lossy, or lossless), as a PNG
+quantized to 256 colours, or as AVIF where OpenCV or ffmpeg can make it; these
+are OUTPUT_FORMATS, compared the same way with -formats:
+    python encode.py [image.png ...] -formats mp4 webp png8 avif
+
+Run this module on folded PNGs (output/screenshot-out by default) to compare the
+profiles' encode time, size and fidelity to the source frame:
+    python encode.py [image.png ...] [-ffmpeg path] [-profiles legacy balanced ...]
+"""
+import argparse
+import functools
+import glob
+import os
+import shutil
+import subprocess
+import time
+
+import cv2
+import numpy as np
+
+X264 = '-c:v libx264 -pix_fmt yuv420p'
+# A still image is read once a second, not at image2's default 25 fps
+STILL_INPUT = '-loop 1 -framerate 1'
+STILL_TIMING = '-t 2 -r 1 -g 2 -bf 0'
+# (input options of a still, its timing, x264 settings)
+ENCODER_PROFILES = {
+    'legacy': ('-loop 1', '-t 2 -r 2', ''),
+    'fastest': (STILL_INPUT, STILL_TIMING, '-tune stillimage -preset ultrafast'),
+    'balanced': (STILL_INPUT, STILL_TIMING, '-tune stillimage -preset veryfast'),
+    # Slower presets came out larger on these flat pages, so this trades quality instead
+    'smallest': (STILL_INPUT, STILL_TIMING, '-tune stillimage -preset veryfast -crf 27'),
+}
+DEFAULT_PROFILE = 'balanced'
+WEBP_QUALITY = 90
+AVIF_QUALITY = 80
+# ffmpeg's AV1 encoders, with their still-image options, in order of preference
+AVIF_ENCODERS = {
+    'libaom-av1': '-still-picture 1 -crf 30 -cpu-used 6',
+    'libsvtav1': '-crf 30 -preset 8',
+}
+
+_encoders = {}  # ffmpeg path -> its encoders
+
+
+def encode_still(in_path, out_path, profile=DEFAULT_PROFILE, ffmpeg='ffmpeg', shell=True):
+    """Encode the image at in_path as an MP4 at out_path with one of ENCODER_PROFILES; whether ffmpeg did"""
+    input_options, timing, x264_options = ENCODER_PROFILES[profile]
+    result = subprocess.run(
+        ffmpeg +
+        ' -y -hide_banner -loglevel error' +
+        f' {input_options} -i {in_path}' +
+        f' {X264} {timing} {x264_options}' +
+        f' {out_path}', shell=shell)
+    return result.returncode == 0 and os.path.exists(out_path)
+
+
+def encode_frames(in_paths, out_path, profile=DEFAULT_PROFILE, ffmpeg='ffmpeg', shell=True):
+    """
+    Encode the images at in_paths as consecutive one-second frames of one MP4 at
+    out_path, in one ffmpeg run. Every frame is a keyframe, so a player seeking to
+    frame N shows exactly image N. The images are linked, or copied, into a
+    numbered sequence beside out_path for ffmpeg to read, and removed afterwards.
+    Returns whether ffmpeg wrote the video.
+    """
+    frame_dir = os.path.splitext(out_path)[0] + "-frames"
+    os.makedirs(frame_dir, exist_ok=True)
+    frame_paths = []
+    for i, in_path in enumerate(in_paths):
+        frame_path = f"{frame_dir}/{i:03d}.png"
+        if os.path.exists(frame_path):
+            os.remove(frame_path)
+        try:
+            os.link(in_path, frame_path)
+        except OSError:
+            shutil.copyfile(in_path, frame_path)
+        frame_paths.append(frame_path)
+    result = subprocess.run(
+        ffmpeg +
+        ' -y -hide_banner -loglevel error' +
+        f' -framerate 1 -i {frame_dir}/%03d.png' +
+        f' {X264} -r 1 -g 1 {ENCODER_PROFILES[profile][2]}' +
+        f' {out_path}', shell=shell)
+    for frame_path in frame_paths:
+        os.remove(frame_path)
+    os.rmdir(frame_dir)
+    return result.returncode == 0 and os.path.exists(out_path)
+
+
+def first_frame(video_path, shape, ffmpeg='ffmpeg', shell=True):
+    """The first frame of a video as a BGR image of the given shape, or None"""
+    result = subprocess.run(
+        ffmpeg +
+        ' -hide_banner -loglevel error' +
+        f' -i {video_path} -frames:v 1 -f rawvideo -pix_fmt bgr24 -', shell=shell, stdout=subprocess.PIPE)
+    if len(result.stdout) != np.prod(shape):
+        return None
+    return np.frombuffer(result.stdout, dtype=np.uint8).reshape(shape)
+
+
+def ffmpeg_encoders(ffmpeg='ffmpeg', shell=True):
+    """Names of the encoders the local ffmpeg was built with, empty if it won't run"""
+    if ffmpeg not in _encoders:
+        result = subprocess.run(ffmpeg + ' -hide_banner -encoders', shell=shell, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+        # A legend, a line of dashes, then ' V....D name  description' per encoder
+        listing = result.stdout.decode('utf-8', 'replace').split('------', 1)[-1]
+        _encoders[ffmpeg] = {line.split()[1] for line in listing.splitlines() if len(line.split()) > 1}
+    return _encoders[ffmpeg]
+
+
+def encode_mp4(in_path, out_path, profile=DEFAULT_PROFILE, ffmpeg='ffmpeg', shell=True):
+    return encode_still(in_path, out_path, profile, ffmpeg, shell)
+
+
+def encode_webp(in_path, out_path, profile=DEFAULT_PROFILE, ffmpeg='ffmpeg', shell=True, quality=WEBP_QUALITY):
+    """WebP by OpenCV; quality above 100 is lossless"""
+    image = cv2.imread(in_path)
+    return image is not None and cv2.imwrite(out_path, image, [cv2.IMWRITE_WEBP_QUALITY, quality])
+
+
+def encode_webp_lossless(in_path, out_path, profile=DEFAULT_PROFILE, ffmpeg='ffmpeg', shell=True):
+    return encode_webp(in_path, out_path, quality=101)
+
+
+def encode_png8(in_path, out_path, profile=DEFAULT_PROFILE, ffmpeg='ffmpeg', shell=True):
+    """A PNG of at most 256 colours picked for this image, as pngquant would make, by ffmpeg"""
+    result = subprocess.run(
+        ffmpeg +
+        ' -y -hide_banner -loglevel error' +
+        f' -i {in_path}' +
+        ' -vf "split[a][b];[a]palettegen=max_colors=256:stats_mode=single[p];[b][p]paletteuse=dither=none"' +
+        ' -pix_fmt pal8' +
+        f' {out_path}', shell=shell)
+    return result.returncode == 0 and os.path.exists(out_path)
+
+
+def encode_avif(in_path, out_path, profile=DEFAULT_PROFILE, ffmpeg='ffmpeg', shell=True):
+    """AVIF by OpenCV if it was built with libavif, else by the first of AVIF_ENCODERS ffmpeg has"""
+    if cv2.haveImageWriter('.avif'):
+        image = cv2.imread(in_path)
+        return image is not None and cv2.imwrite(out_path, image, [cv2.IMWRITE_AVIF_QUALITY, AVIF_QUALITY])
+    encoder = next(name for name in AVIF_ENCODERS if name in ffmpeg_encoders(ffmpeg, shell))
+    result = subprocess.run(
+        ffmpeg +
+        ' -y -hide_banner -loglevel error' +
+        f' -i {in_path}' +
+        f' -c:v {encoder} {AVIF_ENCODERS[encoder]} -pix_fmt yuv420p' +
+        f' {out_path}', shell=shell)
+    return result.returncode == 0 and os.path.exists(out_path)
+
+
+# name -> (extension, encode(in_path, out_path, profile, ffmpeg, shell) -> whether it wrote out_path)
+OUTPUT_FORMATS = {
+    'mp4': ('.mp4', encode_mp4),
+    'webp': ('.webp', encode_webp),
+    'webp-lossless': ('.webp', encode_webp_lossless),
+    'png8': ('.png', encode_png8),
+    'avif': ('.avif', encode_avif),
+}
+
+
+def format_available(name, ffmpeg='ffmpeg', shell=True):
+    """Whether OUTPUT_FORMATS[name] can be written with this OpenCV and ffmpeg"""
+    if name in ('webp', 'webp-lossless'):
+        return cv2.haveImageWriter('.webp')
+    if name == 'avif':
+        return cv2.haveImageWriter('.avif') or any(encoder in ffmpeg_encoders(ffmpeg, shell)
+                                                    for encoder in AVIF_ENCODERS)
+    return {'mp4': 'libx264', 'png8': 'png'}[name] in ffmpeg_encoders(ffmpeg, shell)
+
+
+def decode_output(path, shape, ffmpeg='ffmpeg', shell=True):
+    """An output decoded as the player would, by OpenCV where it can and ffmpeg otherwise"""
+    if not path.endswith('.mp4'):
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is not None:
+            return image
+    return first_frame(path, shape, ffmpeg, shell)
+
+
+def ssim(a, b):
+    """Mean structural similarity of the luma of two BGR images, 11x11 Gaussian windows"""
+    a = cv2.cvtColor(a, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    b = cv2.cvtColor(b, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    c1, c2 = (.01 * 255) ** 2, (.03 * 255) ** 2
+
+    def blur(x):
+        return cv2.GaussianBlur(x, (11, 11), 1.5)
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a * mu_a
+    var_b = blur(b * b) - mu_b * mu_b
+    covariance = blur(a * b) - mu_a * mu_b
+    similarity = ((2 * mu_a * mu_b + c1) * (2 * covariance + c2) /
+                  ((mu_a * mu_a + mu_b * mu_b + c1) * (var_a + var_b + c2)))
+    return float(similarity.mean())
+
+
+def benchmark(image_paths, variants, ffmpeg='ffmpeg', shell=True, out_dir="output/benchmark"):
+    """
+    Encode every image in every variant, (name, extension, encode(in_path, out_path)),
+    printing per variant the total encode time, size and decode time, and the worst fidelity
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    sources = [(path, cv2.imread(path)) for path in image_paths]
+    sources = [(path, image) for path, image in sources if image is not None]
+    print(f"{len(sources)} images")
+    print(f"{'variant':<14} {'encode (s)':>10} {'size (MiB)':>11} {'decode (s)':>10} {'min PSNR':>9} {'min SSIM':>9}")
+    for name, extension, encode in variants:
+        encoding, size, decoding, psnrs, ssims = 0, 0, 0, [], []
+        for path, image in sources:
+            out_path = f"{out_dir}/{os.path.splitext(os.path.basename(path))[0]}-{name}{extension}"
+            start = time.time()
+            encode(path, out_path)
+            encoding += time.time() - start
+            if not os.path.exists(out_path):
+                continue
+            size += os.path.getsize(out_path)
+            start = time.time()
+            decoded = decode_output(out_path, image.shape, ffmpeg, shell)
+            decoding += time.time() - start
+            if decoded is not None:
+                psnrs.append(cv2.PSNR(image, decoded))
+                ssims.append(ssim(image, decoded))
+            os.remove(out_path)
+        worst_psnr = min(psnrs, default=0)
+        # OpenCV reports identical images as 361 dB
+        worst_psnr = f"{worst_psnr:>9.2f}" if worst_psnr < 360 else f"{'lossless':>9}"
+        print(f"{name:<14} {encoding:>10.2f} {size / 2 ** 20:>11.2f} {decoding:>10.2f} "
+              f"{worst_psnr} {min(ssims, default=0):>9.4f}", flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare encoder profiles, or output formats, on folded calendar images')
+    parser.add_argument("images", nargs='*', help="PNGs to encode, by default those in output/screenshot-out")
+    parser.add_argument("-profiles", nargs='+', default=None, choices=list(ENCODER_PROFILES),
+                        help="MP4 profiles to compare, all of them by default")
+    parser.add_argument("-formats", nargs='+', default=None, choices=list(OUTPUT_FORMATS),
+                        help="Output formats to compare instead, MP4s made with the first of -profiles")
+    parser.add_argument("-ffmpeg", default='ffmpeg', help="path to ffmpeg")
+    args = parser.parse_args()
+    shell = os.name != 'nt'
+    image_paths = args.images or sorted(glob.glob("output/screenshot-out/*.png"))
+    if args.formats:
+        profile = args.profiles[0] if args.profiles else DEFAULT_PROFILE
+        variants = []
+        for name in args.formats:
+            if not format_available(name, args.ffmpeg, shell):
+                print(f"{name} can't be written here, skipped")
+                continue
+            extension, encode = OUTPUT_FORMATS[name]
+            variants.append((name, extension, functools.partial(encode, profile=profile, ffmpeg=args.ffmpeg,
+                                                                 shell=shell)))
+    else:
+        variants = [(profile, '.mp4', functools.partial(encode_still, profile=profile, ffmpeg=args.ffmpeg, shell=shell))
+                    for profile in args.profiles or ENCODER_PROFILES]
+    benchmark(image_paths, variants, args.ffmpeg, shell)
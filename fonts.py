@@ -0,0 +1,87 @@
+"""
+Subsets of Noto Sans JP holding only the glyphs a run actually shows
+
+The full CJK fonts are several megabytes each, and every browser launch parses
+them before it can take its screenshot. The subsets are cached under
+output/cache/fonts by the hash of their character set, and faces.css, which
+the pages link to, points at them. Without fontTools (pip install fonttools,
+plus brotli for WOFF2) or the fonts themselves, faces.css names the full fonts.
+"""
+import hashlib
+import html
+import importlib.util
+import os
+
+from cache import CACHE_DIR, keep_newest, replacing
+
+try:
+    from fontTools import subset
+except ImportError:
+    subset = None
+
+# fontTools writes WOFF2 only with brotli installed
+if importlib.util.find_spec('brotli'):
+    SUBSET_FLAVOR, SUBSET_EXT = 'woff2', '.woff2'
+else:
+    SUBSET_FLAVOR, SUBSET_EXT = None, '.otf'
+
+FONT_DIR = "html-resources/fonts/Noto_Sans_JP"
+FONT_CACHE = CACHE_DIR + "/fonts"
+FACES_CSS = FONT_CACHE + "/faces.css"
+FACES = (('normal', 'NotoSansJP-Regular.otf'), ('bold', 'NotoSansJP-Bold.otf'))
+SUBSETS_KEEP = 4  # per face, most recently used first
+FACE_RULE = "@font-face {\n  font-family: 'Noto Sans JP';\n  src: url(%s);\n  font-weight: %s;\n}\n"
+
+
+def used_characters(texts):
+    """Every character the pages display, entities decoded; the markup's ASCII comes along too"""
+    chars = set()
+    for text in texts:
+        chars.update(html.unescape(text))
+    return ''.join(sorted(chars))
+
+
+def subset_font(font_path, chars):
+    """Path of a subset of font_path to chars, made on first use"""
+    stat = os.stat(font_path)
+    key = f"{stat.st_size}:{stat.st_mtime_ns}:{chars}"
+    stem = os.path.splitext(os.path.basename(font_path))[0]
+    out_path = f"{FONT_CACHE}/{stem}-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}{SUBSET_EXT}"
+    if os.path.exists(out_path):
+        os.utime(out_path)
+        return out_path
+
+    options = subset.Options()
+    options.flavor = SUBSET_FLAVOR
+    font = subset.load_font(font_path, options)
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(text=chars)
+    subsetter.subset(font)
+    with replacing(out_path) as tmp_path:
+        subset.save_font(font, tmp_path, options)
+    keep_newest(f"{FONT_CACHE}/{stem}-*{SUBSET_EXT}", SUBSETS_KEEP)
+    return out_path
+
+
+def write_font_faces(texts, subsetting=True):
+    """
+    Write FACES_CSS for pages showing texts, with subset fonts where possible.
+    Returns True if any face points at a subset.
+    """
+    chars = used_characters(texts)
+    rules = []
+    can_subset = subsetting and subset is not None
+    subsetted = False
+    for weight, filename in FACES:
+        font_path = f"{FONT_DIR}/{filename}"
+        # Relative to faces.css
+        url = os.path.relpath(font_path, FONT_CACHE).replace(os.sep, '/')
+        if can_subset and os.path.exists(font_path):
+            url = os.path.basename(subset_font(font_path, chars))
+            subsetted = True
+        rules.append(FACE_RULE % (url, weight))
+
+    os.makedirs(FONT_CACHE, exist_ok=True)
+    with open(FACES_CSS, "w", encoding="utf-8") as f:
+        f.write(''.join(rules))
+    return subsetted
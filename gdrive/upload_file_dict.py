@@ -60,3 +60,5 @@ f_names = [
     "cal_+14.mp4"
 ]
 file_dict = dict(zip(f_names, f_ids))
+# Every offset in one video, for main.py -video combined or both:
+# file_dict["cal_all.mp4"] = "<id of the uploaded cal_all.mp4>"
@@ -98,8 +98,10 @@ def download_banner(service, path):
 
 
 def batch_upload(service, file_list):
+    """Upload each file over the Drive file of its name; returns those that went up"""
+    uploaded = []
     if not service:
-        return
+        return uploaded
     for file_name in file_list:
         base_name = os.path.basename(file_name)
         file_id = file_dict.get(base_name, None)
@@ -107,7 +109,9 @@ def batch_upload(service, file_list):
             print(f"Error: {base_name} not known to the file dict")
             continue
         result = update_file(service, file_id, file_name)
-        if result.get('name', None):
+        if result and result.get('name', None):
+            uploaded.append(file_name)
             print("*", end="", flush=True)
         else:
-            print(result)
\ No newline at end of file
+            print(result)
+    return uploaded
\ No newline at end of file
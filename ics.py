@@ -3,104 +3,502 @@ ical sorting and demangling
 lightly adapted from jeinarsson at:
 https://gist.github.com/jeinarsson/989329deb6906cae49f6e9f979c46ae7/
 """
-from datetime import datetime, timezone
+import heapq
+import io
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 import icalendar
+from dateutil import tz
 from rrule_patched import *
+from rrule_fast import expand_simple
 
+# Longest span a single FREQ period can cover, used to bound COUNT-limited rules
+FREQ_PERIODS = {
+    'YEARLY': timedelta(days=366),
+    'MONTHLY': timedelta(days=31),
+    'WEEKLY': timedelta(weeks=1),
+    'DAILY': timedelta(days=1),
+    'HOURLY': timedelta(hours=1),
+    'MINUTELY': timedelta(minutes=1),
+    'SECONDLY': timedelta(seconds=1),
+}
+# BY* parts that can leave a period without any occurrence, which breaks the COUNT estimate
+SKIPPING_PARTS = {'BYSETPOS', 'BYMONTH', 'BYMONTHDAY', 'BYYEARDAY', 'BYWEEKNO', 'BYEASTER'}
 
-# local tz needs to be passed in for all-day events to show up correctly
-# there's probably a more efficient way of doing this.
-def get_events_from_ics(ics_string, window_start, window_end, local_tz=timezone.utc):
-    events = []
 
-    def append_event(e):
+def split_rule(recur_rule):
+    """Split an RRULE value into a dict of upper-cased NAME: VALUE strings"""
+    parts = {}
+    for pair in recur_rule.upper().split(';'):
+        name, _, value = pair.partition('=')
+        parts[name] = value
+    return parts
 
-        if e['startdt'] > window_end:
-            return
-        if e['enddt']:
-            if e['enddt'] < window_start:
-                return
 
-        events.append(e)
+def parse_until(value, tzinfo):
+    """
+    Mirror rrule_patched's handling of UNTIL: the wall-clock fields are kept
+    and re-labelled with the tz of DTSTART. Returns None if it can't be read.
+    """
+    value = value.rstrip('Z')
+    try:
+        if 'T' in value:
+            until = datetime.strptime(value, '%Y%m%dT%H%M%S')
+        else:
+            until = datetime.strptime(value, '%Y%m%d')
+    except ValueError:
+        return None
+    return until.replace(tzinfo=tzinfo)
 
-    def get_recurrent_datetimes(recur_rule, start, exclusions, all_day=False):
-        rules = rruleset()
-        first_rule = rrulestr(recur_rule, dtstart=start)
-        rules.rrule(first_rule)
-        if not isinstance(exclusions, list):
-            exclusions = [exclusions]
 
-        for xdt in exclusions:
+def rule_bounds(parts, start):
+    """
+    Cheap (lower, upper) bounds on the occurrences of a split RRULE, without building it.
+    upper is None when the series is open-ended or too irregular to estimate.
+    """
+    upper = None
+    if 'UNTIL' in parts:
+        upper = parse_until(parts['UNTIL'], start.tzinfo)
+    elif 'COUNT' in parts:
+        freq = parts.get('FREQ')
+        period = FREQ_PERIODS.get(freq)
+        irregular = (
+            period is None
+            or SKIPPING_PARTS.intersection(parts)
+            # Without BYMONTHDAY, MONTHLY/YEARLY repeat DTSTART's day, which not every period has
+            or (freq == 'MONTHLY' and 'BYDAY' not in parts and start.day > 28)
+            or (freq == 'YEARLY' and 'BYDAY' not in parts and (start.month, start.day) == (2, 29))
+            # BYDAY filters DAILY/sub-daily rules, and ordinals (5FR) can miss a month
+            or ('BYDAY' in parts and (freq not in ('WEEKLY', 'MONTHLY', 'YEARLY') or
+                                      any(c.isdigit() for c in parts['BYDAY'])))
+            or (freq in ('HOURLY', 'MINUTELY', 'SECONDLY') and any(n.startswith('BY') for n in parts))
+        )
+        if not irregular:
             try:
-                rules.exdate(xdt.dt)
-            except AttributeError:
-                pass
-
-        dates = []
-
-        # Fixes: Issue where all-day recurring events are excluded on "Today"
-        recur_win_start = window_start
-        if all_day:
-            recur_win_start = datetime(window_start.year, window_start.month, window_start.day, tzinfo=local_tz)
-        # Fix-Continued: Above + Set search to "Inclusive"
-        for d in rules.between(recur_win_start, window_end, inc=True):
-            dates.append(d)
-        return dates
+                spans = int(parts['COUNT']) * int(parts.get('INTERVAL') or 1) + 1
+                upper = start + spans * period
+            except (ValueError, OverflowError):
+                upper = None
+    return start, upper
+
+
+def date_to_datetime(d, local_tz):
+    return datetime(d.year, d.month, d.day, tzinfo=local_tz)
+
+
+def exdate_values(exdate):
+    """Flatten the EXDATE property (one vDDDLists per line) into plain date/datetime values"""
+    if exdate is None:
+        return []
+    if not isinstance(exdate, list):
+        exdate = [exdate]
+    return [x.dt for xlist in exdate for x in getattr(xlist, 'dts', [])]
+
 
+def read_event_defs(ics_string, with_details=True):
+    """
+    Parse the calendar once into plain dicts, one per VEVENT.
+    All-day events keep their floating dates; they are only pinned to a tz on expansion.
+    Description and location are left as None unless with_details is set.
+    """
+    defs = []
     cal = filter(lambda c: c.name == 'VEVENT',
                  icalendar.Calendar.from_ical(ics_string).walk()
                  )
-
-    def date_to_datetime(d):
-        return datetime(d.year, d.month, d.day, tzinfo=local_tz)
-
     for vevent in cal:
-        summary = str(vevent.get('summary'))
-        description = str(vevent.get('description'))
-        location = str(vevent.get('location'))
         rawstartdt = vevent.get('dtstart').dt
         try:
             rawenddt = vevent.get('dtend').dt
         except AttributeError:
             continue
-        startdt = None
-        enddt = None
-        allday = False
-        if not isinstance(rawstartdt, datetime):
-            allday = True
-            startdt = date_to_datetime(rawstartdt)
-            enddt = date_to_datetime(rawenddt)
-        else:
-            startdt = rawstartdt
-            enddt = rawenddt
-
-        exdate = vevent.get('exdate')
-        if vevent.get('rrule'):
-            reoccur = vevent.get('rrule').to_ical().decode('utf-8')
-            for d in get_recurrent_datetimes(reoccur, startdt, exdate, allday):
-                if allday:
-                    d = datetime(d.year, d.month, d.day, tzinfo=local_tz)
-
-                new_e = {
-                    'startdt': d,
-                    'allday': allday,
-                    'summary': summary,
-                    'desc': description,
-                    'loc': location
-                }
-                if enddt:
-                    new_e['enddt'] = d + (enddt - startdt)
-                append_event(new_e)
-        else:
+        uid = vevent.get('uid')
+        rrule = vevent.get('rrule')
+        recurrence_id = vevent.get('recurrence-id')
+        last_modified = vevent.get('last-modified')
+        defs.append({
+            'uid': str(uid) if uid else None,
+            'recurrence_id': recurrence_id.dt if recurrence_id else None,
+            'sequence': int(vevent.get('sequence', 0)),
+            'modified': last_modified.dt if last_modified else None,
+            'summary': str(vevent.get('summary')),
+            'desc': str(vevent.get('description')) if with_details else None,
+            'loc': str(vevent.get('location')) if with_details else None,
+            'start': rawstartdt,
+            'end': rawenddt,
+            'allday': not isinstance(rawstartdt, datetime),
+            'rrule': rrule.to_ical().decode('utf-8') if rrule else None,
+            'exdates': exdate_values(vevent.get('exdate')),
+        })
+    return defs
+
+
+# Properties the streaming reader keeps; everything else in a VEVENT is skipped unparsed
+STREAM_PROPS = {'UID', 'RECURRENCE-ID', 'SEQUENCE', 'LAST-MODIFIED', 'SUMMARY',
+                'DTSTART', 'DTEND', 'RRULE', 'EXDATE'}
+DETAIL_PROPS = {'DESCRIPTION', 'LOCATION'}
+TEXT_ESCAPES = re.compile(r'\\([\;,nN])')
+STREAM_CHUNK = 64 * 1024
+# What dateutil's tzical understands of a VTIMEZONE; it rejects anything else, such as X-LIC-LOCATION
+TZICAL_PROPS = {'BEGIN', 'END', 'TZID', 'DTSTART', 'TZOFFSETFROM', 'TZOFFSETTO', 'RRULE', 'RDATE', 'TZNAME', 'COMMENT'}
+VTIMEZONE_BLOCK = re.compile(rb'^BEGIN:VTIMEZONE\r?$.*?^END:VTIMEZONE\r?\n', re.DOTALL | re.MULTILINE)
+
+
+def _physical_lines(chunks):
+    pending = b''  # last, possibly incomplete, line of the previous chunk
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+
+def iter_ics_lines(source):
+    """
+    Unfolded content lines of a calendar, decoded one at a time.
+    source can be bytes/str, an mmap, or anything with read(n) such as an HTTP response.
+    """
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    if isinstance(source, (bytes, bytearray)):
+        chunks = [bytes(source)]
+    else:
+        chunks = iter(lambda: source.read(STREAM_CHUNK), b'')
+
+    logical = None
+    for line in _physical_lines(chunks):
+        line = line.rstrip(b'\r')
+        # Folding happens at octets, so rejoin before decoding
+        if line[:1] in (b' ', b'\t') and logical is not None:
+            logical += line[1:]
+            continue
+        if logical is not None:
+            yield logical.decode('utf-8', errors='replace')
+        logical = line
+    if logical is not None:
+        yield logical.decode('utf-8', errors='replace')
+
+
+def split_content_line(line):
+    """NAME;PARAM=V;...:VALUE -> (NAME, {PARAM: V}, VALUE), honouring quoted parameter values"""
+    quoted = False
+    for i, c in enumerate(line):
+        if c == '"':
+            quoted = not quoted
+        elif c == ':' and not quoted:
+            break
+    else:
+        return line.upper(), {}, ''
+    name, *params = line[:i].split(';')
+    param_dict = {}
+    for param in params:
+        key, _, value = param.partition('=')
+        param_dict[key.upper()] = value.strip('"')
+    return name.upper(), param_dict, line[i + 1:]
+
+
+def read_vtimezone(lines):
+    """{TZID: tzinfo} of the content lines of one VTIMEZONE, empty if dateutil can't read it"""
+    kept = [line for line in lines if split_content_line(line)[0] in TZICAL_PROPS]
+    try:
+        zones = tz.tzical(io.StringIO('\n'.join(kept)))
+    except ValueError:
+        return {}
+    return {tzid: zones.get(tzid) for tzid in zones.keys()}
+
+
+def parse_ics_datetime(value, params, zones=None):
+    """
+    A DATE or DATE-TIME value as icalendar would give it. TZIDs are resolved by
+    name, else from zones, the feed's VTIMEZONEs; a TZID neither knows is taken as UTC.
+    """
+    value = value.strip()
+    if params.get('VALUE') == 'DATE' or len(value) == 8:
+        return datetime.strptime(value, '%Y%m%d').date()
+    if value.endswith('Z'):
+        return datetime.strptime(value[:-1], '%Y%m%dT%H%M%S').replace(tzinfo=timezone.utc)
+    dt = datetime.strptime(value, '%Y%m%dT%H%M%S')
+    if 'TZID' in params:
+        tzid = params['TZID']
+        dt = dt.replace(tzinfo=tz.gettz(tzid) or (zones or {}).get(tzid) or timezone.utc)
+    return dt
+
+
+def unescape_text(value):
+    return TEXT_ESCAPES.sub(lambda m: '\n' if m.group(1) in 'nN' else m.group(1), value)
+
+
+def _stream_event_def(props, with_details, zones):
+    def first(name):
+        return props[name][0] if name in props else None
+
+    def text(name):
+        prop = first(name)
+        return unescape_text(prop[1]) if prop else str(None)
+
+    def when(name):
+        prop = first(name)
+        return parse_ics_datetime(prop[1], prop[0], zones) if prop else None
+
+    if 'DTSTART' not in props or 'DTEND' not in props:
+        return None
+    rawstartdt = when('DTSTART')
+    sequence = first('SEQUENCE')
+    rrule = first('RRULE')
+    return {
+        'uid': first('UID')[1] if 'UID' in props else None,
+        'recurrence_id': when('RECURRENCE-ID'),
+        'sequence': int(sequence[1]) if sequence else 0,
+        'modified': when('LAST-MODIFIED'),
+        'summary': text('SUMMARY'),
+        'desc': text('DESCRIPTION') if with_details else None,
+        'loc': text('LOCATION') if with_details else None,
+        'start': rawstartdt,
+        'end': when('DTEND'),
+        'allday': not isinstance(rawstartdt, datetime),
+        'rrule': rrule[1] if rrule else None,
+        'exdates': [parse_ics_datetime(v, params, zones) for params, value in props.get('EXDATE', [])
+                    for v in value.split(',')],
+    }
+
+
+def iter_event_defs(source, with_details=True):
+    """
+    Streaming alternative to read_event_defs, yielding the same dicts one VEVENT at a time.
+    Only the properties the calendar uses are parsed; VALARM and the rest are skipped
+    line by line, so memory doesn't grow with the size of the feed. VTIMEZONEs are
+    kept, for TZIDs that aren't known by name, and must come before the events using them.
+    """
+    wanted = STREAM_PROPS | DETAIL_PROPS if with_details else STREAM_PROPS
+    zones = {}  # TZID -> tzinfo of the VTIMEZONEs read so far
+    vtimezone = None  # lines of the VTIMEZONE being read, if any
+    props = None  # properties of the VEVENT being read, if any
+    nested = 0  # depth of components (VALARM) inside it
+    for line in iter_ics_lines(source):
+        if vtimezone is not None:
+            vtimezone.append(line)
+            if line.upper() == 'END:VTIMEZONE':
+                zones.update(read_vtimezone(vtimezone))
+                vtimezone = None
+            continue
+        if props is None:
+            if line.upper() == 'BEGIN:VEVENT':
+                props = {}
+            elif line.upper() == 'BEGIN:VTIMEZONE':
+                vtimezone = [line]
+            continue
+        upper = line[:6].upper()
+        if upper.startswith('BEGIN:'):
+            nested += 1
+        elif upper.startswith('END:'):
+            if nested:
+                nested -= 1
+                continue
+            defn = _stream_event_def(props, with_details, zones)
+            if defn:
+                yield defn
+            props = None
+        elif not nested:
+            name, params, value = split_content_line(line)
+            if name in wanted:
+                props.setdefault(name, []).append((params, value))
+
+
+def merge_event_defs(feeds):
+    """
+    Definitions of several feeds as one list. An event (UID, RECURRENCE-ID) already seen
+    in an earlier feed is only kept once, as its highest SEQUENCE.
+    """
+    merged = []
+    seen = {}  # (uid, recurrence_id) -> position in merged, for earlier feeds
+    for defs in feeds:
+        added = {}
+        for defn in defs:
+            key = (defn['uid'], defn['recurrence_id'])
+            if defn['uid'] and key in seen:
+                pos = seen[key]
+                if defn['sequence'] > merged[pos]['sequence']:
+                    merged[pos] = defn
+                continue
+            added.setdefault(key, len(merged))
+            merged.append(defn)
+        seen.update((key, pos) for key, pos in added.items() if key[0])
+    return merged
+
+
+def recur_window_start(window_start, all_day, local_tz):
+    # Fixes: Issue where all-day recurring events are excluded on "Today"
+    if all_day:
+        return date_to_datetime(window_start, local_tz)
+    return window_start
+
+
+def could_recur_in_window(parts, start, recur_win_start, window_end):
+    lower, upper = rule_bounds(parts, start)
+    try:
+        if lower > window_end:
+            return False
+        if upper is not None and upper < recur_win_start:
+            return False
+    except TypeError:
+        # naive (floating) DTSTART against an aware window, leave it to rrule
+        pass
+    return True
+
+
+def exclusion_datetimes(exclusions, start, local_tz):
+    """EXDATE values made comparable with the occurrences of a rule starting at 'start'"""
+    xdts = []
+    for xdt in exclusions:
+        if not isinstance(xdt, datetime):
+            xdt = date_to_datetime(xdt, local_tz)
+        elif xdt.tzinfo is None and start.tzinfo is not None:
+            xdt = xdt.replace(tzinfo=start.tzinfo)
+        xdts.append(xdt)
+    return xdts
+
+
+def get_recurrent_datetimes(recur_rule, parts, start, exclusions, recur_win_start, window_end, local_tz):
+    exclusions = exclusion_datetimes(exclusions, start, local_tz)
+    # Plain DAILY/WEEKLY/MONTHLY rules don't need the full rrule machinery
+    dates = expand_simple(parts, start, exclusions, recur_win_start, window_end)
+    if dates is not None:
+        return dates
+
+    rules = rruleset()
+    first_rule = rrulestr(recur_rule, dtstart=start)
+    rules.rrule(first_rule)
+    for xdt in exclusions:
+        rules.exdate(xdt)
+
+    # Fix-Continued: Set search to "Inclusive"
+    return rules.between(recur_win_start, window_end, inc=True)
+
+
+def make_event(defn, startdt, enddt, recurring):
+    return {
+        'startdt': startdt,
+        'enddt': enddt,
+        'allday': defn['allday'],
+        'recurring': recurring,
+        'summary': defn['summary'],
+        'desc': defn['desc'],
+        'loc': defn['loc']
+    }
+
+
+def in_window(e, window_start, window_end):
+    if e['startdt'] > window_end:
+        return False
+    if e['enddt']:
+        if e['enddt'] < window_start:
+            return False
+    return True
+
+
+def expand_event(defn, window_start, window_end, local_tz=timezone.utc):
+    """Yield the occurrences of one event definition that touch the window"""
+    allday = defn['allday']
+    if allday:
+        startdt = date_to_datetime(defn['start'], local_tz)
+        enddt = date_to_datetime(defn['end'], local_tz)
+    else:
+        startdt = defn['start']
+        enddt = defn['end']
+
+    if defn['rrule']:
+        recur_win_start = recur_window_start(window_start, allday, local_tz)
+        parts = split_rule(defn['rrule'])
+        if not could_recur_in_window(parts, startdt, recur_win_start, window_end):
+            return
+        for d in get_recurrent_datetimes(defn['rrule'], parts, startdt, defn['exdates'],
+                                         recur_win_start, window_end, local_tz):
             if allday:
-                startdt = datetime(startdt.year, startdt.month, startdt.day, tzinfo=local_tz)
-            append_event({
-                'startdt': startdt,
-                'enddt': enddt,
-                'allday': allday,
-                'summary': summary,
-                'desc': description,
-                'loc': location
-            })
-    events.sort(key=lambda e: (e['startdt'], 0 if e['allday'] else 1))
+                d = date_to_datetime(d, local_tz)
+            new_e = make_event(defn, d, d + (enddt - startdt), True)
+            if in_window(new_e, window_start, window_end):
+                yield new_e
+    else:
+        new_e = make_event(defn, startdt, enddt, False)
+        if in_window(new_e, window_start, window_end):
+            yield new_e
+
+
+def expand_events(defs, window_start, window_end, local_tz=timezone.utc):
+    """Occurrences of every definition in the window, in definition order (unsorted)"""
+    events = []
+    for defn in defs:
+        events.extend(expand_event(defn, window_start, window_end, local_tz))
+    return events
+
+
+def event_sort_key(e):
+    # By instant: aware datetimes in a DST fold never compare equal across zones (PEP 495),
+    # which would leave ties in an order that depends on the input
+    return e['startdt'].timestamp(), 0 if e['allday'] else 1
+
+
+def sort_events(events):
+    events.sort(key=event_sort_key)
     return events
+
+
+# local tz needs to be passed in for all-day events to show up correctly
+def get_events_from_ics(ics_string, window_start, window_end, local_tz=timezone.utc):
+    defs = read_event_defs(ics_string)
+    return sort_events(expand_events(defs, window_start, window_end, local_tz))
+
+
+def split_calendar(raw, parts):
+    """
+    Split raw ical bytes at BEGIN:VEVENT boundaries into up to 'parts' standalone calendars
+    of about equal size. Every VTIMEZONE is copied into every part.
+    """
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8')
+    starts = [m.start() for m in re.finditer(rb'^BEGIN:VEVENT', raw, re.MULTILINE)]
+    if not starts:
+        return [raw]
+    end = raw.rfind(b'END:VCALENDAR')
+    if end < starts[-1]:
+        end = len(raw)
+    # The header (VCALENDAR properties and, usually, every VTIMEZONE) plus any zones defined later
+    header = raw[:starts[0]] + b''.join(VTIMEZONE_BLOCK.findall(raw, starts[0]))
+    if not header.endswith(b'\n'):
+        header += b'\r\n'
+
+    target = (end - starts[0]) / max(1, parts)
+    chunks = []
+    chunk_start = starts[0]
+    for pos in starts[1:]:
+        if pos - chunk_start >= target and len(chunks) < parts - 1:
+            chunks.append(header + raw[chunk_start:pos] + b'END:VCALENDAR\r\n')
+            chunk_start = pos
+    chunks.append(header + raw[chunk_start:end] + b'END:VCALENDAR\r\n')
+    return chunks
+
+
+def _parse_and_expand(chunk, window_start, window_end, local_tz, with_details):
+    defs = read_event_defs(chunk, with_details)
+    return defs, sort_events(expand_events(defs, window_start, window_end, local_tz))
+
+
+def parallel_events_from_ics(raw, window_start, window_end, local_tz=timezone.utc, workers=None,
+                             with_details=True):
+    """
+    (definitions, sorted occurrences) of a large calendar, parsed and expanded in chunks
+    across processes. The sorted chunks are k-way merged; ties keep definition order,
+    so the result matches sort_events over the whole calendar.
+    """
+    chunks = split_calendar(raw, workers or os.cpu_count() or 1)
+    n = len(chunks)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(_parse_and_expand, chunks, [window_start] * n, [window_end] * n,
+                                [local_tz] * n, [with_details] * n))
+    defs = [defn for chunk_defs, _ in results for defn in chunk_defs]
+    events = list(heapq.merge(*(chunk_events for _, chunk_events in results),
+                              key=event_sort_key))
+    return defs, events
+
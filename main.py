@@ -5,19 +5,33 @@ This generates three html documents, in the timezones declared in "tzs"
 from the ical accessible at "url"
 """
 import argparse
-import html
+import hashlib
+import mmap
 import os
+import shutil
 import subprocess
 import time
-import urllib.error
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from string import Template
 
 import cv2
+import urllib3
 from dateutil import tz
 
+from banner import PNG_FAST, ingest_banner
+from cache import ExpansionCache, cached_event_defs, load_event_defs, replacing, store_event_defs
+from changes import is_unchanged, record_published
+from compose import CHROME_HEIGHT, LABEL_TILE_HEIGHT, PAGE_SIZE, atlas_panel, bottom_is_blank, label_strip_html
+from encode import DEFAULT_PROFILE, ENCODER_PROFILES, OUTPUT_FORMATS, encode_frames, format_available
+from fonts import write_font_faces
 from ics import *
+from occurrences import OccurrenceTable, fixed_offset, project_events
+from page_server import PageServer
+from raster import LABELS_BOX, NativeRenderer, estimate_height
+from reshape import FOLD_SIZE, Reshaper, sized_path
+from runs import RUN_DIR, STAGES, Run
+from templates import CalendarTemplate, atlas_document
+from validate import chrome_problem, page_problem, strip_problem
 from gdrive_upload import batch_upload, setup_service, download_banner
 
 from sys import platform
@@ -34,41 +48,147 @@ LOOKAHEAD = 14  # Days
 ENABLE_DESCRIPTIONS = False
 MAX_DETAIL_LINES = 4
 CHARS_PER_DETAIL_LINE = 80
+PARALLEL_PARSE_BYTES = 2 * 1024 * 1024  # Feeds at least this big are parsed across processes
+PARSE_WORKERS = None  # None for one per core, 1 to always parse in-process
+REUSE_PARSES = True  # Reuse the definitions parsed from identical feed bytes, see cache.load_event_defs
+REUSE_EXPANSION = True  # Slide the last run's occurrences forward, see cache.ExpansionCache; -cache or not
+SUBSET_FONTS = True  # Cut Noto Sans JP down to the characters on the pages, needs fontTools
+ATLAS_COLUMNS = 3  # Panels side by side in an atlas render
+ATLAS_PANELS = 6  # Panels per atlas; Firefox won't screenshot past 32767px either way
+SHARE_IDENTICAL_RENDERS = True  # Offsets with the same calendar are rendered once and relabelled
+FIT_CONTENT_HEIGHT = True  # Render only as much of the page as the calendar fills, the rest is padded
+SCREENSHOT_RETRIES = 2  # Further attempts at a screenshot that fails validation, per page
+RESHAPE_WORKERS = None  # None for one per core, 1 to always reshape in-process
 
 BANNER_PATH = "html-resources/banner/current.png"
+COMBINED_MP4 = "cal_all.mp4"  # Every offset in one video, see -video
+COMBINED_OFFSETS = range(-12, 15)  # Frame N of it shows offset N - 12
+OUTPUT_SIZES = [FOLD_SIZE]  # Sides of the square outputs; smaller ones are scaled from the one render
+# (x, y, w, h) of the full-size output that change every run without the calendar changing; the footer labels
+VOLATILE_REGIONS = [LABELS_BOX]
+REPUBLISH_AFTER = timedelta(hours=24)  # Outputs that look unchanged are still published when this stale
 
 
 def filesafe_str(in_str):
     return "".join([c for c in in_str if c.isalpha() or c.isdigit() or c == ' ' or c == '-' or c == '+']).rstrip()
 
 
-def generate_calendars(ical_url, canonical_tzs, use_cache=False):
-    if use_cache and os.path.exists("calendar.ical"):
+def calendar_cache_path(feed_num):
+    # The first feed keeps the original name, so existing caches stay valid
+    return "calendar.ical" if feed_num == 0 else f"calendar_{feed_num}.ical"
+
+
+def request_feed(http, ical_url, preload_content=True):
+    response = http.request('GET', ical_url, preload_content=preload_content)
+    if response.status != 200:
+        response.release_conn()
+        raise urllib3.exceptions.HTTPError(f"{ical_url} returned HTTP {response.status}")
+    return response
+
+
+def read_calendar(http, ical_url, cache_path, table_window, use_cache=False, stream=False):
+    """
+    Event definitions of the calendar at ical_url, from the local copy when caching.
+    With REUSE_PARSES, a feed whose bytes were parsed before isn't parsed again,
+    whether fetched or cached; except when streamed off HTTP, which never holds them.
+    Returns (definitions, occurrences in table_window or None): feeds past
+    PARALLEL_PARSE_BYTES are parsed and expanded across processes in one go.
+    """
+    if stream:
+        # Read off the mmap'd local copy, or straight off the HTTP body, never holding the whole file
+        response = None
+        try:
+            if use_cache:
+                # An empty copy can't be mapped, so it's fetched again
+                if not os.path.exists(cache_path) or not os.path.getsize(cache_path):
+                    response = request_feed(http, ical_url, preload_content=False)
+                    # A dropped connection leaves no partial file behind
+                    with replacing(cache_path) as tmp_path, open(tmp_path, "wb") as f:
+                        shutil.copyfileobj(response, f)
+                with open(cache_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return load_event_defs(mm, iter_event_defs, ENABLE_DESCRIPTIONS), None
+            response = request_feed(http, ical_url, preload_content=False)
+            return list(iter_event_defs(response, ENABLE_DESCRIPTIONS)), None
+        finally:
+            if response is not None:
+                response.release_conn()
+
+    if use_cache and os.path.exists(cache_path):
         # print("Using Cached")
-        with open("calendar.ical", "r", encoding="utf-8") as f:
+        with open(cache_path, "rb") as f:
             ics_string = f.read()
     else:
         # print("Requesting Calendar")
-        with urllib.request.urlopen(ical_url) as response:
-            try:
-                ics_string = response.read()
-            except urllib.error as e:
-                print(e)
-                raise
+        ics_string = request_feed(http, ical_url).data
 
         if use_cache:
-            with open('calendar.ical', "wb") as f:
+            with replacing(cache_path) as tmp_path, open(tmp_path, "wb") as f:
                 f.write(ics_string)
 
-    with open("html-resources/template/head.html", "r", encoding="utf-8") as f:
-        head_html_template = Template(f.read())
-    with open("html-resources/template/tail.html", "r", encoding="utf-8") as f:
-        tail_html = f.read()
+    if REUSE_PARSES:
+        event_defs = cached_event_defs(ics_string, read_event_defs, ENABLE_DESCRIPTIONS)
+        if event_defs is not None:
+            return event_defs, None
 
-    files = []
+    table_events = None
+    if len(ics_string) >= PARALLEL_PARSE_BYTES and PARSE_WORKERS != 1:
+        event_defs, table_events = parallel_events_from_ics(ics_string, *table_window, workers=PARSE_WORKERS,
+                                                            with_details=ENABLE_DESCRIPTIONS)
+    else:
+        event_defs = read_event_defs(ics_string, ENABLE_DESCRIPTIONS)
+
+    if REUSE_PARSES:
+        store_event_defs(ics_string, read_event_defs, ENABLE_DESCRIPTIONS, event_defs)
+    return event_defs, table_events
+
+
+def read_calendars(ical_urls, table_window, use_cache=False, stream=False):
+    """
+    read_calendar for every feed, fetched concurrently over one pooled connection manager,
+    so the wait is that of the slowest feed. Several feeds are merged into one timeline.
+    """
+    http = urllib3.PoolManager(maxsize=len(ical_urls))
+    with ThreadPoolExecutor(max_workers=len(ical_urls)) as pool:
+        results = list(pool.map(lambda i: read_calendar(http, ical_urls[i], calendar_cache_path(i), table_window,
+                                                        use_cache, stream),
+                                range(len(ical_urls))))
+    if len(results) == 1:
+        return results[0]
+    # Occurrences expanded per feed can't be deduplicated, so the merged definitions are expanded afresh
+    return merge_event_defs([event_defs for event_defs, _ in results]), None
+
+
+def generate_calendars(ical_urls, canonical_tzs, use_cache=False, stream=False, composite=False):
+    """
+    One page per timezone: {'name', 'labels': (timezone, now), 'rows', 'document', 'same_as', 'height'}.
+    A page whose calendar matches an earlier one's gets no document of its own and
+    names that page in 'same_as'; it only differs by its footer labels.
+    When compositing, documents hold only the calendar body, and every page also
+    carries the run's one 'chrome' document to be rendered once and stacked on top.
+    'height' is how much of the page, chrome included, needs rendering to show
+    the whole calendar; the full page height unless FIT_CONTENT_HEIGHT.
+    """
+    if isinstance(ical_urls, str):
+        ical_urls = [ical_urls]
+    # The banner pre-scaled to the header, linked relative to the page
+    banner = os.path.relpath(ingest_banner(BANNER_PATH), "output/html").replace(os.sep, '/')
+    template = CalendarTemplate(ENABLE_DESCRIPTIONS, MAX_DETAIL_LINES, CHARS_PER_DETAIL_LINE, banner)
+    chrome = template.chrome_document() if composite else None
+
+    now = datetime.now(timezone.utc)
+    window_end = now + timedelta(days=LOOKAHEAD)
+    # Fixed-offset zones all project from one expansion in UTC, padded a day for all-day events
+    table_start, table_end = now - timedelta(days=1), window_end + timedelta(days=1)
+    utc_table = None
+
+    # Parse once; every zone is a projection of the same definitions
+    event_defs, table_events = read_calendars(ical_urls, (table_start, table_end), use_cache, stream)
+
+    pages = []
+    rendered = {}  # calendar hash -> name of the page rendering it
     for can_tz in canonical_tzs:
         loc_tz = tz.gettz(can_tz)
-        today = datetime.now(loc_tz)
+        today = now.astimezone(loc_tz)
         # For generating files with the UTC offset in the filename instead, use this:
         offset = today.utcoffset() - today.astimezone(timezone.utc).utcoffset()
         offset_num = int(offset.total_seconds() / 3600)
@@ -76,121 +196,461 @@ def generate_calendars(ical_url, canonical_tzs, use_cache=False):
         if offset_num >= 0:
             offset_h = '+' + offset_h
         # if you instead wish to use the canonical name, pass in "loc_tz" instead of "offset_h" here:
-        filename = f'cal_{filesafe_str(str(offset_h))}.html'
-        window_end = today + timedelta(days=LOOKAHEAD)
-        events = get_events_from_ics(ics_string, today, window_end, loc_tz)
-        fname = os.path.abspath("output/html") + os.sep + filename
-        files.append(fname)
-        with open(fname, "w", encoding="utf-8") as out:
-            out.write(head_html_template.substitute(timezone=str(offset_h), now=today.strftime('%b %d @ %H:%M')))
-            out.write(f"<div class=\"calendar\"><table>\n")
-            day = None
-            for e in events:
-                evt_start = e['startdt'].astimezone(tz=loc_tz)
-                e_date = evt_start.strftime('%b %d')
-                if e_date != day:
-                    out.write(f"\t<tr><td colspan=\"2\" class=\"date\">{e_date}</td></tr>\n")
-                day = e_date
-                evt_end = e.get('enddt', None)
-
-                if e['allday']:
-                    time_line = f"\t<tr><td class=\"starttime\">&nbsp;</td>"
-                elif evt_end:
-                    evt_end = evt_end.astimezone(tz=loc_tz)
-                    time_line = f"\t<tr><td class=\"starttime\">{evt_start.strftime('%H:%M')} ~ " + \
-                                f"<span class=\"endtime\">{evt_end.strftime('%H:%M')}</span></td>"
+        name = f'cal_{filesafe_str(str(offset_h))}'
+
+        fixed_secs = fixed_offset(loc_tz)
+        if fixed_secs is not None:
+            if utc_table is None:
+                if table_events is not None:
+                    utc_table = OccurrenceTable(table_events)
+                elif REUSE_EXPANSION:
+                    # Keyed by each event's UID, SEQUENCE and LAST-MODIFIED, so safe on a freshly fetched feed
+                    expansion = ExpansionCache()
+                    utc_table = OccurrenceTable(expansion.expand(event_defs, table_start, table_end))
+                    expansion.save()
                 else:
-                    time_line = f"\t<tr><td class=\"starttime\">{evt_start.strftime('%H:%M')}</td>"
-
-                summary_line = f"<td class=\"summary{' allday' if e['allday'] else ''}\">{html.escape(e['summary'])}"
-
-                desc_line = ""
-                if ENABLE_DESCRIPTIONS and e['desc'] and len(e['desc']) > 4:
-                    desc_array = list(filter(None, e['desc'].split('\n')))
-                    trunc = False
-                    if len(desc_array) > MAX_DETAIL_LINES:
-                        desc_array = desc_array[:MAX_DETAIL_LINES]
-                        trunc = True
-                    desc_str = '\n'.join(desc_array)
-                    if len(desc_str) > (CHARS_PER_DETAIL_LINE * MAX_DETAIL_LINES):
-                        desc_str = desc_str[:CHARS_PER_DETAIL_LINE * MAX_DETAIL_LINES]
-                        desc_str = desc_str[:desc_str.rfind(" ")]
-                        trunc = True
-                    if trunc:
-                        desc_str = desc_str + "...\n[Description Truncated; More info on online calendar]"
-
-                    desc_line = f"<br /><span class=\"details\">{html.escape(desc_str)}</span>"
-
-                details_close = "</td></tr>\n"
-
-                out.write(time_line + summary_line + desc_line + details_close)
-
-            out.write("</table>\n</div>\n")
-            out.write(tail_html)
+                    utc_table = OccurrenceTable(expand_events(event_defs, table_start, table_end))
+            rows = utc_table.project(fixed_secs, now, window_end)
+        else:
+            rows = project_events(sort_events(expand_events(event_defs, today, window_end, loc_tz)), loc_tz)
+
+        labels = (str(offset_h), today.strftime('%b %d @ %H:%M'))
+        calendar_html = template.table(rows)
+
+        # The labels are left out of the hash: they're pasted on per page after rendering
+        digest = hashlib.sha256(calendar_html.encode('utf-8')).digest()
+        same_as = rendered.get(digest) if SHARE_IDENTICAL_RENDERS else None
+        page = {'name': name, 'labels': labels, 'rows': rows, 'document': None, 'same_as': same_as,
+                'chrome': chrome, 'height': PAGE_SIZE[1]}
+        if same_as is None:
+            rendered[digest] = name
+            if FIT_CONTENT_HEIGHT:
+                page['height'] = estimate_height(rows, ENABLE_DESCRIPTIONS, MAX_DETAIL_LINES, CHARS_PER_DETAIL_LINE)
+            if composite:
+                page['document'] = template.body_document(calendar_html)
+            else:
+                page['document'] = template.document(labels, calendar_html)
+        pages.append(page)
         print("*", end="", flush=True)
-    return files
 
+    # Labels pasted on from the strip count as well, they're not in any document
+    write_font_faces([page['document'] for page in pages if page['document']] +
+                     [' '.join(page['labels']) for page in pages] + [chrome or ''], SUBSET_FONTS)
+    return pages
 
-def generate_with_firefox(html_paths):
-    calendar_images_tmp = []
+
+def screenshot_with_firefox(url, out_path, width=2048, height=8192):
     suppress_opt = ''
     if LINUX_MODE:
         suppress_opt = ' >/dev/null 2>&1'
-    for in_path in html_paths:
-        out_path = in_path.replace(".html", ".png").replace("html", "screenshot-in")
-        calendar_images_tmp.append(out_path)
-        subprocess.run(
-            FIREFOX_PATH +
-            ' --headless --profile TEMP_FIREFOX --no-remote' +
-            f' --screenshot {out_path}' +
-            f' file:///{in_path} ' +
-            ' --window-size=2048,8192' + suppress_opt, shell=LINUX_MODE)
-        os.remove(in_path)
+    subprocess.run(
+        FIREFOX_PATH +
+        ' --headless --profile TEMP_FIREFOX --no-remote' +
+        f' --screenshot {out_path}' +
+        f' {url} ' +
+        f' --window-size={width},{height}' + suppress_opt, shell=LINUX_MODE)
+
+
+def cut_short(image, height):
+    """Whether a render of the top 'height' rows of a page has its calendar running off the bottom"""
+    return height < PAGE_SIZE[1] and image is not None and not bottom_is_blank(image)
+
+
+def checked_screenshot(url, out_path, check, width=2048, height=8192):
+    """
+    screenshot_with_firefox, taken again up to SCREENSHOT_RETRIES times while
+    check(image) reports a fault. Returns the image, or None with the file
+    removed if every attempt was faulty, so it can't reach the encoder.
+    """
+    for attempt in range(1 + SCREENSHOT_RETRIES):
+        screenshot_with_firefox(url, out_path, width, height)
+        image = cv2.imread(out_path)
+        problem = check(image)
+        if problem is None:
+            return image
+        print(f"\nScreenshot {os.path.basename(out_path)} {problem} (attempt {attempt + 1})", end=" ", flush=True)
+    if os.path.exists(out_path):
+        os.remove(out_path)
+    return None
+
+
+def page_url(server, filename, document, html_to_disk=False):
+    if html_to_disk:
+        # Left in output/html afterwards, for inspection
+        in_path = os.path.abspath("output/html") + os.sep + filename
+        with open(in_path, "w", encoding="utf-8") as out:
+            out.write(document)
+        return f"file:///{in_path}"
+    return server.add(filename, document)
+
+
+def rendered_paths(page):
+    """The screenshots a page's reshape reads"""
+    paths = [page.get('screenshot'), page.get('chrome_screenshot'), page.get('label_tile', (None,))[0]]
+    return [path for path in paths if path]
+
+
+def generate_with_firefox(pages, html_to_disk=False, atlas=False, run=None):
+    """
+    Screenshots every page with a document into 'screenshot', only its top
+    'height' rows (less the chrome's when compositing). With atlas, up to
+    ATLAS_PANELS pages share one screenshot as panels of one document, and get
+    'atlas_panel': (index, columns, panel height) into it as well. Pages sharing
+    another's render, and all pages when compositing, get 'label_tile':
+    (strip screenshot, tile index) from one extra screenshot of all their footers.
+    The chrome, if any, is rendered once into each page's 'chrome_screenshot'.
+    Every screenshot is checked by validate.py; faulty ones are taken again, and
+    a faulty atlas panel or a page whose calendar runs off the bottom of its
+    shortened render is rendered again on its own, the latter at full height.
+    Documents are served from memory over loopback unless html_to_disk.
+    Pages the run has rendered already are left as they are; each of the rest is
+    recorded in it once its screenshots are taken.
+    """
+    run = run or Run()
+    if all(run.done('render', page['name']) for page in pages):
+        return pages
+    shot_dir = os.path.abspath("output/screenshot-in") + os.sep
+    with PageServer() as server:
+        # The chrome and footers are shared, so they're taken again whenever any page is
+        chrome = next((page['chrome'] for page in pages if page['chrome']), None)
+        if chrome:
+            chrome_path = shot_dir + "chrome.png"
+            checked_screenshot(page_url(server, "chrome.html", chrome, html_to_disk), chrome_path,
+                               chrome_problem, height=CHROME_HEIGHT)
+            for page in pages:
+                page['chrome_screenshot'] = chrome_path
+            print("*", end="", flush=True)
+
+        relabelled = [page for page in pages if page['same_as'] or page['chrome']]
+        if relabelled:
+            strip_path = shot_dir + "labels.png"
+            strip_html = label_strip_html([page['labels'] for page in relabelled])
+            checked_screenshot(page_url(server, "labels.html", strip_html, html_to_disk), strip_path,
+                               lambda strip: strip_problem(strip, len(relabelled)),
+                               height=LABEL_TILE_HEIGHT * len(relabelled))
+            for i, page in enumerate(relabelled):
+                page['label_tile'] = (strip_path, i)
+            print("*", end="", flush=True)
+        for page in pages:
+            if page['same_as'] and not run.done('render', page['name']):
+                run.complete('render', page['name'], rendered_paths(page))
+
+        below = CHROME_HEIGHT if chrome else 0  # rows of each page's height taken by the chrome
+        rendered = [page for page in pages if not page['same_as'] and not run.done('render', page['name'])]
+        singles = [] if atlas else rendered
+        for first in range(0, len(rendered) if atlas else 0, ATLAS_PANELS):
+            panels = rendered[first:first + ATLAS_PANELS]
+            columns = min(len(panels), ATLAS_COLUMNS)
+            atlas_rows = -(-len(panels) // columns)
+            # Panels are laid out in a grid, so all are as tall as the tallest
+            height = max(page['height'] for page in panels) - below
+            # A name no file has, so an atlas that pages of a resumed run still read is never
+            # overwritten, even when one of its panels is rendered again as the first of another
+            attempt = 0
+            while os.path.exists(shot_dir + f"atlas_{panels[0]['name']}_{attempt}.png"):
+                attempt += 1
+            filename = f"atlas_{panels[0]['name']}_{attempt}.html"
+            atlas_path = shot_dir + filename.replace(".html", ".png")
+            atlas_html = atlas_document([page['document'] for page in panels], height)
+            screenshot_with_firefox(page_url(server, filename, atlas_html, html_to_disk), atlas_path,
+                                    width=columns * PAGE_SIZE[0], height=atlas_rows * height)
+            server.remove(filename)
+            shot = cv2.imread(atlas_path)
+            for i, page in enumerate(panels):
+                panel = atlas_panel(shot, i, columns, height) if shot is not None else None
+                if cut_short(panel, height + below):
+                    page['height'] = PAGE_SIZE[1]
+                    singles.append(page)
+                    continue
+                if page_problem(panel, not chrome, bool(page['rows'])):
+                    singles.append(page)
+                    continue
+                page['screenshot'] = atlas_path
+                page['atlas_panel'] = (i, columns, height)
+                run.complete('render', page['name'], rendered_paths(page))
+                print("*", end="", flush=True)
+            if shot is not None and all(page in singles for page in panels):
+                os.remove(atlas_path)
+
+        for page in singles:
+            filename = page['name'] + ".html"
+            url = page_url(server, filename, page['document'], html_to_disk)
+            page['screenshot'] = shot_dir + page['name'] + ".png"
+
+            def check(image):
+                return page_problem(image, not chrome, bool(page['rows']))
+            image = checked_screenshot(url, page['screenshot'], check, height=page['height'] - below)
+            if cut_short(image, page['height']):
+                page['height'] = PAGE_SIZE[1]
+                checked_screenshot(url, page['screenshot'], check, height=page['height'] - below)
+            server.remove(filename)
+            page.pop('atlas_panel', None)
+            run.complete('render', page['name'], rendered_paths(page))
+            print("*", end="", flush=True)
+    return pages
+
+
+def generate_natively(pages, run=None):
+    """The same screenshots as generate_with_firefox, drawn by raster.NativeRenderer without a browser"""
+    run = run or Run()
+    if all(run.done('render', page['name']) for page in pages):
+        return pages
+    renderer = NativeRenderer(ingest_banner(BANNER_PATH), ENABLE_DESCRIPTIONS, MAX_DETAIL_LINES,
+                              CHARS_PER_DETAIL_LINE)
+    shot_dir = os.path.abspath("output/screenshot-in") + os.sep
+    composite = any(page['chrome'] for page in pages)
+    if composite:
+        cv2.imwrite(shot_dir + "chrome.png", renderer.chrome(), PNG_FAST)
+        for page in pages:
+            page['chrome_screenshot'] = shot_dir + "chrome.png"
+
+    relabelled = [page for page in pages if page['same_as'] or page['chrome']]
+    if relabelled:
+        strip_path = shot_dir + "labels.png"
+        cv2.imwrite(strip_path, renderer.label_strip([page['labels'] for page in relabelled]), PNG_FAST)
+        for i, page in enumerate(relabelled):
+            page['label_tile'] = (strip_path, i)
+
+    for page in pages:
+        if run.done('render', page['name']):
+            continue
+        if page['same_as']:
+            run.complete('render', page['name'], rendered_paths(page))
+            continue
+        page['screenshot'] = shot_dir + page['name'] + ".png"
+        while True:
+            if composite:
+                image = renderer.body(page['rows'], page['height'] - CHROME_HEIGHT)
+            else:
+                image = renderer.page(page['labels'], page['rows'], page['height'])
+            if not cut_short(image, page['height']):
+                break
+            page['height'] = PAGE_SIZE[1]
+        cv2.imwrite(page['screenshot'], image, PNG_FAST)
+        run.complete('render', page['name'], rendered_paths(page))
         print("*", end="", flush=True)
-
-    return calendar_images_tmp
+    return pages
+
+
+def reshape_with_ocv(pages, sizes=OUTPUT_SIZES, volatile=VOLATILE_REGIONS, run=None):
+    """
+    Folds each screenshot into a square, stacked under the chrome when compositing,
+    and labels it for the page and every page sharing that render. Screenshots
+    cut short of the full page are padded out with their last row.
+    Each is written at every one of sizes, named as reshape.sized_path does, and
+    its changes.signature, blind to the volatile regions, kept in the page's
+    'signatures': {path: signature}.
+    Pages are reshaped in parallel by RESHAPE_WORKERS processes, see reshape.py.
+    Only pages the run has rendered but not reshaped are, each recorded in it with
+    its images; the screenshots are left for the cleanup.
+    Returns the folded image paths written, in page order, then largest first.
+    """
+    run = run or Run()
+    shared = {}
+    for page in pages:
+        if page['same_as']:
+            shared.setdefault(page['same_as'], []).append(page)
+    out_dir = os.path.abspath("output/screenshot-out")
+
+    result_paths = set()
+    owners = {}  # output path -> page it shows
+    with Reshaper(RESHAPE_WORKERS) as reshaper:
+        specs = {}  # path -> shared image spec, for images many pages read
+
+        def spec_of(path):
+            if path not in specs:
+                specs[path] = reshaper.share(path)
+                if specs[path] is None:
+                    print(f"Image did not exist at path {path}")
+            return specs[path]
+
+        def collect(futures):
+            for future, labelled in futures:
+                written, messages = future.result()
+                for message in messages:
+                    print(message)
+                for path, image_signature in written:
+                    owners[path].setdefault('signatures', {})[path] = image_signature
+                    result_paths.add(path)
+                    print("*", end="", flush=True)
+                for other in labelled:
+                    # Pages left without images are reshaped again on resuming, their screenshots taken again first
+                    paths = [path for path, _ in written if owners[path] is other]
+                    if paths:
+                        run.complete('reshape', other['name'], paths)
+
+        futures = []
+        atlas_path = None  # one atlas held at a time, its panels are consecutive
+        for page in pages:
+            if page['same_as'] or not run.done('render', page['name']):
+                continue
+            labelled = [other for other in [page] + shared.get(page['name'], [])
+                        if run.ready('reshape', other['name'])]
+            if not labelled:
+                continue
+            chrome = None
+            if page.get('chrome_screenshot'):
+                chrome = spec_of(page['chrome_screenshot'])
+                if chrome is None:
+                    continue
+            outputs = []
+            for other in labelled:
+                tile = None
+                if 'label_tile' in other:
+                    strip_path, index = other['label_tile']
+                    strip = spec_of(strip_path)
+                    if strip is None:
+                        print(f"Could not label {page['name']} as {other['name']}")
+                        continue
+                    tile = (strip, index)
+                out_path = out_dir + os.sep + other['name'] + ".png"
+                outputs.append((out_path, tile))
+                for size in sizes:
+                    owners[sized_path(out_path, size)] = other
+
+            source = page['screenshot']
+            if 'atlas_panel' in page:
+                if source != atlas_path:
+                    # The last atlas's panels are done before it is let go
+                    collect(futures)
+                    futures = []
+                    if atlas_path:
+                        reshaper.release(atlas_path)
+                    atlas_path = source
+                atlas = spec_of(source)
+                if atlas is None:
+                    continue
+                source = (atlas,) + page['atlas_panel']
+            futures.append((reshaper.reshape(source, chrome, outputs, sizes, volatile), labelled))
+        collect(futures)
+
+    return [path for path in (sized_path(out_dir + os.sep + page['name'] + ".png", size)
+                              for page in pages for size in sorted(sizes, reverse=True)) if path in result_paths]
+
+
+def changed_images(pages, image_paths, max_age=REPUBLISH_AFTER):
+    """
+    Those of image_paths that look different, outside VOLATILE_REGIONS, from when
+    they were last published, or were published longer than max_age ago
+    """
+    signatures = {}
+    for page in pages:
+        signatures.update(page.get('signatures', {}))
+    return [path for path in image_paths
+            if path not in signatures or
+            not is_unchanged(os.path.splitext(os.path.basename(path))[0], signatures[path], max_age)]
+
+
+def mark_published(pages, image_paths, uploaded, sizes=OUTPUT_SIZES):
+    """
+    Remember how those of image_paths looked that went up in uploaded, as an output
+    of their own or as a frame of the COMBINED_MP4 of their size
+    """
+    uploaded_names = {os.path.splitext(os.path.basename(path))[0] for path in uploaded}
+    combined = os.path.splitext(COMBINED_MP4)[0]
+    for page in pages:
+        for size in sizes:
+            name = sized_path(page['name'], size)
+            if name not in uploaded_names and sized_path(combined, size) not in uploaded_names:
+                continue
+            for path, image_signature in page.get('signatures', {}).items():
+                if path in image_paths and os.path.splitext(os.path.basename(path))[0] == name:
+                    record_published(name, image_signature)
+
+
+def writable_formats(formats):
+    """
+    Those of the encode.OUTPUT_FORMATS named that this OpenCV and ffmpeg can write,
+    less any with the extension of one before it: Drive knows outputs by file name
+    """
+    writable = {}
+    for name in formats:
+        extension = OUTPUT_FORMATS[name][0]
+        if extension in writable:
+            print(f"{name} would be uploaded over {writable[extension]}, skipped", end=" ")
+        elif format_available(name, FFMPEG_PATH, LINUX_MODE):
+            writable[extension] = name
+        else:
+            print(f"Can't write {name} here, skipped", end=" ")
+    return list(writable.values())
 
 
-def reshape_with_ocv(image_paths):
+def embed_into_outputs(image_paths, formats=('mp4',), profile=DEFAULT_PROFILE, encoded=None):
+    """
+    Encode each image in each of the writable_formats given, into output/<format>,
+    MP4s with one of encode.ENCODER_PROFILES. encoded is {(image hash, format): output}
+    of outputs already made from identical pixels, to share across calls.
+    Returns the paths written; those that failed to encode are left out.
+    """
     result_paths = []
+    encoded = {} if encoded is None else encoded
     for full_path in image_paths:
-        image = cv2.imread(full_path)
-        try:
-            if image.size == 0:
-                print(f"Image did not exist at path {full_path}")
+        with open(full_path, "rb") as f:
+            digest = hashlib.sha256(f.read()).digest()
+        for name in formats:
+            extension, encode = OUTPUT_FORMATS[name]
+            out_dir = os.path.abspath("output/" + name)
+            os.makedirs(out_dir, exist_ok=True)
+            new_path = out_dir + os.sep + os.path.splitext(os.path.basename(full_path))[0] + extension
+            if (digest, name) in encoded:
+                shutil.copyfile(encoded[digest, name], new_path)
+            elif encode(full_path, new_path, profile, FFMPEG_PATH, LINUX_MODE):
+                encoded[digest, name] = new_path
+            else:
+                print(f"Couldn't write {os.path.basename(new_path)}", end=" ")
                 continue
-        except AttributeError:
-            print(f"Image did not exist at path {full_path}")
-            continue
-        sz = image.shape  # y, x, z
-        im_l = image[:sz[1] * 2, :, :]
-        im_r = image[sz[1] * 2:, :, :]
-        im_h = cv2.hconcat([im_l, im_r])
-        new_path = full_path.replace("screenshot-in", "screenshot-out")
-        result_paths.append(new_path)
-        cv2.imwrite(new_path, im_h)
-        os.remove(full_path)
+            result_paths.append(new_path)
         print("*", end="", flush=True)
     return result_paths
 
 
-def embed_into_mp4(image_paths):
+def embed_into_combined_mp4(pages, image_paths, profile=DEFAULT_PROFILE, sizes=OUTPUT_SIZES):
+    """
+    Encode the images as the frames of one MP4, output/mp4/COMBINED_MP4, frame N
+    being offset COMBINED_OFFSETS[N], for players to seek to the viewer's frame;
+    one per size, named as reshape.sized_path does.
+    Returns the paths written; none for a size unless every offset has an image.
+    """
+    by_name = {os.path.splitext(os.path.basename(path))[0]: path for path in image_paths}
     result_paths = []
-    for full_path in image_paths:
-        new_path = full_path.replace(".png", ".mp4")
-        new_path = new_path.replace("screenshot-out", "mp4")
-        result_paths.append(new_path)
-        subprocess.run(
-            FFMPEG_PATH +
-            ' -y -hide_banner -loglevel error' +
-            f' -loop 1 -i {full_path}' +
-            ' -c:v libx264 -t 2 -r 2 -pix_fmt yuv420p' +
-            f' {new_path}', shell=LINUX_MODE)
-        os.remove(full_path)
+    for size in sorted(sizes, reverse=True):
+        out_path = sized_path(os.path.abspath("output/mp4") + os.sep + COMBINED_MP4, size)
+        by_offset = {int(page['labels'][0]): by_name[sized_path(page['name'], size)] for page in pages
+                     if sized_path(page['name'], size) in by_name}
+        missing = [offset for offset in COMBINED_OFFSETS if offset not in by_offset]
+        if missing:
+            print(f"No {os.path.basename(out_path)}, missing offsets {missing}", end=" ")
+            continue
+        if not encode_frames([by_offset[offset] for offset in COMBINED_OFFSETS], out_path, profile, FFMPEG_PATH,
+                             LINUX_MODE):
+            print(f"ffmpeg failed on {os.path.basename(out_path)}", end=" ")
+            continue
+        result_paths.append(out_path)
         print("*", end="", flush=True)
     return result_paths
 
 
+def clean_up(pages, run, combined_pending=False):
+    """
+    Remove the screenshots and square images of pages the run has encoded, and
+    whose outputs are all there; uploading needs neither. Nothing is removed
+    while the combined video, which is made from every page's images, is pending.
+    """
+    if combined_pending:
+        print("Kept for the combined video", end=" ")
+        return
+    for page in pages:
+        if not run.done('encode', page['name']) or run.done('cleanup', page['name']) or \
+                not all(map(os.path.exists, run.paths('encode', page['name']))):
+            continue
+        for path in run.paths('render', page['name']) + run.paths('reshape', page['name']):
+            # Shared screenshots are listed under several pages
+            if os.path.exists(path):
+                os.remove(path)
+        run.complete('cleanup', page['name'])
+        print("*", end="", flush=True)
+
+
 def print_elapsed(last_t):
     segment = time.time()
     print(f'] {segment - last_t :.2f}s', flush=True)
@@ -198,8 +658,8 @@ def print_elapsed(last_t):
 
 
 def do_tasks(args, goog_service):
-    url = 'https://calendar.google.com/calendar/ical/' + \
-          'a62rkiqhau8bn341cepfbc4k0s%40group.calendar.google.com/public/basic.ics'
+    urls = ['https://calendar.google.com/calendar/ical/' +
+            'a62rkiqhau8bn341cepfbc4k0s%40group.calendar.google.com/public/basic.ics']
 
     tzs = []
     for i in range(12 + 14 + 1):
@@ -210,7 +670,7 @@ def do_tasks(args, goog_service):
         tzs.append(can_string)
 
     if args.url is not None:
-        url = args.url
+        urls = args.url
     if args.tzs is not None:
         if isinstance(args.tzs, list):
             tzs = args.tzs
@@ -219,26 +679,103 @@ def do_tasks(args, goog_service):
 
     start = time.time()
     last = start
-    total = len(tzs)
-    print(f"Generating Calendars for {total} timezones\n[", end="")
-    cal_results = generate_calendars(url, tzs, args.cache)
-    last = print_elapsed(last)
-
-    print(f"Rendering images from html\n[", end="")
-    pre_imgs = generate_with_firefox(cal_results)
-    last = print_elapsed(last)
-
-    print(f"Formatting to Square with OpenCV\n[", end="")
-    post_imgs = reshape_with_ocv(pre_imgs)
-    last = print_elapsed(last)
-
-    print(f"Using FFMPEG to embed in an MP4\n[", end="")
-    post_mp4 = embed_into_mp4(post_imgs)
-    last = print_elapsed(last)
-
-    if goog_service:
-        print(f"Uploading files to Google Drive\n[", end="")
-        batch_upload(goog_service, post_mp4)
+    stages = [stage for stage in STAGES if stage in args.stages]
+    run = Run(RUN_DIR)
+    if (stages[0] == 'calendars' and not args.resume) or not run.load():
+        if stages[0] != 'calendars':
+            print(f"No run in {RUN_DIR} to {stages[0]}, start one with the calendars stage")
+            return
+        total = len(tzs)
+        print(f"Generating Calendars for {total} timezones\n[", end="")
+        run.start(generate_calendars(urls, tzs, args.cache, args.stream, args.composite))
+        last = print_elapsed(last)
+    else:
+        for page in run.pages:
+            # The pages are saved between stages, so a run that died during one recorded more than they show
+            if run.paths('render', page['name']) != rendered_paths(page):
+                run.forget('render', page['name'])
+            elif not set(run.paths('reshape', page['name'])) <= set(page.get('signatures', {})):
+                run.forget('reshape', page['name'])
+        if not args.resume:
+            # The chosen stages are done over, and so is everything made from what they made
+            run.forget(stages[0])
+    # Files gone missing are made again, if their stage is chosen
+    run.revalidate()
+    cal_results = run.pages
+    names = [page['name'] for page in cal_results] + [COMBINED_MP4]
+
+    if 'render' in stages:
+        # Saved however the stage ends, so a resumed run keeps every page it finished
+        try:
+            if args.renderer == 'native':
+                print(f"Rendering images natively\n[", end="")
+                generate_natively(cal_results, run)
+            else:
+                print(f"Rendering images from html\n[", end="")
+                generate_with_firefox(cal_results, args.html, args.atlas, run)
+        finally:
+            run.save_pages()
+        last = print_elapsed(last)
+
+    if 'reshape' in stages:
+        print(f"Formatting to Square with OpenCV\n[", end="")
+        try:
+            reshape_with_ocv(cal_results, args.sizes, run=run)
+        finally:
+            run.save_pages()
+        last = print_elapsed(last)
+
+    if 'encode' in stages:
+        todo = [page for page in cal_results if run.ready('encode', page['name'])]
+        # Offsets that look as they did when last published are neither encoded nor uploaded again
+        for page in todo:
+            images = run.paths('reshape', page['name'])
+            page['changed'] = images if args.force else changed_images([page], images)
+        # Before encoding, so uploads after a failure still know what they publish
+        run.save_pages()
+        changed_count = sum(len(page['changed']) for page in todo)
+        image_count = sum(len(run.paths('reshape', page['name'])) for page in todo)
+        print(f"Encoding {changed_count} of {image_count} images as {', '.join(args.formats)}\n[", end="")
+        if args.video != 'offsets' and not run.done('encode', COMBINED_MP4) and \
+                any(page.get('changed') for page in cal_results):
+            # Every frame is needed again once any has changed
+            post_imgs = [path for page in cal_results for path in run.paths('reshape', page['name'])]
+            combined = embed_into_combined_mp4(cal_results, post_imgs, args.encoder, args.sizes)
+            # Not done until written, so a resumed run with every offset at hand makes it
+            if combined:
+                run.complete('encode', COMBINED_MP4, combined)
+        formats = writable_formats(args.formats) if args.video != 'combined' else []
+        encoded = {}
+        for page in todo:
+            outputs = embed_into_outputs(page['changed'], formats, args.encoder, encoded)
+            # Not done with any output missing, or none writable here, so that resuming makes them
+            if len(outputs) < len(page['changed']) * len(formats) or \
+                    (page['changed'] and not formats and args.video != 'combined'):
+                continue
+            run.complete('encode', page['name'], outputs)
+        last = print_elapsed(last)
+
+    if 'upload' in stages:
+        todo = [name for name in names if run.ready('upload', name)]
+        post_outputs = [path for name in todo for path in run.paths('encode', name)]
+        if goog_service and post_outputs:
+            print(f"Uploading files to Google Drive\n[", end="")
+        changed_imgs = [path for page in cal_results for path in page.get('changed', [])]
+        for name in todo:
+            # Outputs that weren't made, or didn't go up, aren't remembered as published
+            outputs = [path for path in run.paths('encode', name) if os.path.exists(path)]
+            uploaded = batch_upload(goog_service, outputs)
+            mark_published(cal_results, changed_imgs, uploaded, args.sizes)
+            # Anything left behind is uploaded on resuming, with Drive at hand
+            if goog_service and len(uploaded) == len(run.paths('encode', name)):
+                run.complete('upload', name)
+        if goog_service and post_outputs:
+            last = print_elapsed(last)
+
+    if 'cleanup' in stages:
+        print("Removing screenshots and images\n[", end="")
+        clean_up(cal_results, run, args.video != 'offsets' and not run.done('encode', COMBINED_MP4) and
+                 any(page.get('changed') for page in cal_results))
         print_elapsed(last)
 
     end = time.time()
@@ -247,9 +784,36 @@ def do_tasks(args, goog_service):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate some calendars')
-    parser.add_argument("-url", default=None, help="url to the .ical")
+    parser.add_argument("-url", default=None, metavar='U', nargs='+',
+                        help="url(s) to the .ical, several feeds are merged into one calendar")
     parser.add_argument("-tzs", default=None, metavar='T', nargs='+', help="list of canonical timezones")
     parser.add_argument("-cache", action='store_true', default=False, help="Enable locally caching ical")
+    parser.add_argument("-stream", action='store_true', default=False,
+                        help="Parse the ical with the lightweight streaming reader instead of icalendar")
+    parser.add_argument("-renderer", default='firefox', choices=['firefox', 'native'],
+                        help="Screenshot the HTML with Firefox, or draw the same layout natively (needs Pillow)")
+    parser.add_argument("-composite", action='store_true', default=False,
+                        help="Render the banner and footer once, and only the calendar for each timezone")
+    parser.add_argument("-atlas", action='store_true', default=False,
+                        help="Render several timezones per screenshot, as panels of one document")
+    parser.add_argument("-encoder", default=DEFAULT_PROFILE, choices=list(ENCODER_PROFILES),
+                        help="x264 settings for the MP4s; python encode.py compares them")
+    parser.add_argument("-formats", default=['mp4'], nargs='+', choices=list(OUTPUT_FORMATS),
+                        help="What to encode each timezone's image as, one per extension; "
+                             "python encode.py -formats compares them")
+    parser.add_argument("-sizes", default=OUTPUT_SIZES, nargs='+', type=int, choices=[FOLD_SIZE, 2048, 1024, 512],
+                        help="Sides of the square outputs; all but the full size get it as a suffix, e.g. cal_+0_2048")
+    parser.add_argument("-video", default='offsets', choices=['offsets', 'combined', 'both'],
+                        help=f"One MP4 per offset, all offsets as the frames of {COMBINED_MP4}, or both")
+    parser.add_argument("-force", action='store_true', default=False,
+                        help="Encode and upload every timezone, even those that look unchanged since last published")
+    parser.add_argument("-stages", default=STAGES, nargs='+', choices=STAGES,
+                        help="Which steps to run; without cleanup the screenshots and square images are kept")
+    parser.add_argument("-resume", action='store_true', default=False,
+                        help=f"Carry on with the run in {RUN_DIR} from where it stopped, with the same options, "
+                             f"reusing what it made")
+    parser.add_argument("-html", action='store_true', default=False,
+                        help="Write the generated HTML to output/html and render it from there, for debugging")
     args = parser.parse_args()
 
     # If gdrive_service is none, this will still return run but skip all google steps.
@@ -0,0 +1,105 @@
+"""
+Projection of expanded events into the rows of one timezone's calendar
+
+The canonical zones are all Etc/GMT+-N, which are fixed offsets. For those the
+occurrences are expanded once in UTC and every zone becomes a few vectorized
+numpy operations on the same arrays, instead of a reparse, re-expansion and
+per-event astimezone/strftime.
+"""
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from dateutil import tz
+
+MINUTE = np.timedelta64(1, 'm')
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# strftime lookups, so that labels match the per-event path in the current locale
+MONTH_ABBR = [datetime(2000, m, 1).strftime('%b') for m in range(1, 13)]
+HH_MM = ['%02d:%02d' % divmod(m, 60) for m in range(24 * 60)]
+
+
+def fixed_offset(loc_tz):
+    """Offset from UTC in seconds if loc_tz never changes it, otherwise None"""
+    if loc_tz is None:
+        return None
+    if isinstance(loc_tz, (timezone, tz.tzutc, tz.tzoffset)):
+        return int(loc_tz.utcoffset(datetime.now()).total_seconds())
+    # Etc/GMT+-N (and UTC) tzfiles carry no transitions at all
+    if isinstance(loc_tz, tz.tzfile) and not getattr(loc_tz, '_trans_list_utc', True):
+        return int(loc_tz.utcoffset(datetime.now()).total_seconds())
+    return None
+
+
+def project_events(events, loc_tz):
+    """
+    Rows of (event, date label, start HH:MM, end HH:MM) for any zone,
+    from events already expanded and sorted for that zone.
+    """
+    rows = []
+    for e in events:
+        evt_start = e['startdt'].astimezone(tz=loc_tz)
+        evt_end = e.get('enddt', None)
+        if evt_end:
+            evt_end = evt_end.astimezone(tz=loc_tz).strftime('%H:%M')
+        rows.append((e, evt_start.strftime('%b %d'), evt_start.strftime('%H:%M'), evt_end))
+    return rows
+
+
+def _to_datetime64(dt):
+    # Exact to the microsecond, so ties sort the same as the datetimes themselves
+    return np.datetime64((dt - EPOCH) // timedelta(microseconds=1), 'us')
+
+
+class OccurrenceTable:
+    """
+    Events expanded in UTC, held as parallel datetime64 arrays.
+
+    Expand over a window padded by a day on both sides: all-day events are
+    kept as their floating (wall-clock) midnight, so a zone up to 14h either
+    side of UTC can still see all of its local days.
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.allday = np.array([e['allday'] for e in events], dtype=bool)
+        self.recurring = np.array([e['recurring'] for e in events], dtype=bool)
+        # For timed events these are UTC instants, for all-day events floating wall times
+        self.start = np.array([_to_datetime64(e['startdt']) for e in events], dtype='datetime64[us]')
+        self.end = np.array([_to_datetime64(e['enddt']) for e in events], dtype='datetime64[us]')
+
+    def project(self, offset, window_start, window_end):
+        """
+        Same rows as project_events would give for a zone 'offset' seconds east of UTC,
+        filtered and ordered the way expand_events and sort_events would for that zone.
+        """
+        shift = np.timedelta64(offset, 's').astype('timedelta64[us]')
+        win_start = _to_datetime64(window_start) + shift
+        win_end = _to_datetime64(window_end) + shift
+        # Local wall-clock times; all-day events are already on the wall clock
+        start = np.where(self.allday, self.start, self.start + shift)
+        end = np.where(self.allday, self.end, self.end + shift)
+
+        # Recurrences are searched from the window start (local midnight for all-day ones),
+        # single events only have to end after it. See expand_event.
+        midnight = win_start.astype('datetime64[D]').astype('datetime64[us]')
+        recur_start = np.where(self.allday, midnight, win_start)
+        keep = (start <= win_end) & (end >= win_start) & (~self.recurring | (start >= recur_start))
+
+        idx = np.flatnonzero(keep)
+        # Stable, by start then all-day first
+        idx = idx[np.lexsort((~self.allday[idx], start[idx]))]
+        start = start[idx]
+        end = end[idx]
+
+        start_day = start.astype('datetime64[D]')
+        month = start_day.astype('datetime64[M]')
+        month_num = month.astype(np.int64) % 12
+        month_day = (start_day - month).astype(np.int64) + 1
+        start_min = ((start - start_day) // MINUTE).astype(np.int64)
+        end_min = ((end - end.astype('datetime64[D]')) // MINUTE).astype(np.int64)
+
+        rows = []
+        for i, mon, mday, s_min, e_min in zip(idx.tolist(), month_num.tolist(), month_day.tolist(),
+                                              start_min.tolist(), end_min.tolist()):
+            rows.append((self.events[i], '%s %02d' % (MONTH_ABBR[mon], mday), HH_MM[s_min], HH_MM[e_min]))
+        return rows
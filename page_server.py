@@ -0,0 +1,89 @@
+"""
+Loopback HTTP server handing generated pages to the browser straight from memory
+
+Pages are registered under the path they would have on disk (output/html/...),
+so the relative links to ../../html-resources resolve just as they do from a
+file:/// URL. Static files are read once and then served from memory as well.
+"""
+import mimetypes
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+STATIC_DIRS = ("html-resources", "output/cache/fonts", "output/cache/banner")
+PAGE_DIR = "output/html"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body, content_type = self.server.page_server.lookup(unquote(self.path.split("?", 1)[0]))
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PageServer:
+    """
+    with PageServer() as server:
+        url = server.add("cal_+0.html", document)
+    Serves on an ephemeral 127.0.0.1 port for as long as the block runs.
+    """
+
+    def __init__(self, static_dirs=STATIC_DIRS):
+        self.static_dirs = [os.path.normpath(d) for d in static_dirs]
+        self.pages = {}
+        self._static = {}
+        self._httpd = None
+
+    def add(self, name, document):
+        """Serve document as PAGE_DIR/name, returning its URL"""
+        path = f"/{PAGE_DIR}/{name}"
+        self.pages[path] = document.encode('utf-8')
+        return self.url(path)
+
+    def remove(self, name):
+        self.pages.pop(f"/{PAGE_DIR}/{name}", None)
+
+    def url(self, path):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+    def lookup(self, path):
+        """(bytes, content type) for a request path, or (None, None)"""
+        if path in self.pages:
+            return self.pages[path], "text/html; charset=utf-8"
+        if path not in self._static:
+            self._static[path] = self._read_static(path)
+        body = self._static[path]
+        if body is None:
+            return None, None
+        return body, mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    def _read_static(self, path):
+        rel_path = os.path.normpath(path.lstrip('/'))
+        if not any(rel_path.startswith(d + os.sep) for d in self.static_dirs):
+            return None
+        try:
+            with open(rel_path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def __enter__(self):
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._httpd.page_server = self
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
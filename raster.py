@@ -0,0 +1,351 @@
+"""
+Browser-free rendering of the calendar page straight into a NumPy image
+
+The layout is simple enough to draw directly: the banner, scrollbars, spacer
+and footer are fixed boxes from style.css, and the calendar is a two-column
+table of date headers and time/summary rows in one font. Glyphs are
+rasterized once per (face, size) by FreeType through Pillow and kept as alpha
+masks, so a page is a few thousand small blends rather than a browser launch.
+
+The output follows Firefox's layout closely but not to the pixel; run this
+module with a Firefox screenshot of the same page to compare the two.
+"""
+import re
+
+import cv2
+import numpy as np
+
+from banner import scale_to_cover
+from compose import BODY_HEIGHT, CHROME_HEIGHT, LABEL_TILE_HEIGHT, PAGE_SIZE
+from fonts import FACES, FONT_DIR
+from templates import truncate_description
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    ImageFont = None
+
+# style.css colours, as BGR
+BACKGROUND = (0xE9, 0xEA, 0xCA)
+SCROLLBAR = (0xCF, 0xD0, 0x8E)
+SPACER = (0xDB, 0xF2, 0xFF)
+HEADER = (0xFF, 0xFF, 0xFF)
+FOOTER_BORDER = (0xA1, 0xA1, 0x5F)
+DATE_BACKGROUND = (0x67, 0x68, 0x19)
+TIME_BACKGROUND = (0x8A, 0x88, 0x3B)
+LIGHT_TEXT = (0xF4, 0xFB, 0xFB)
+DARK_TEXT = (0x00, 0x00, 0x00)
+
+# Boxes as (x, y, width, height), worked out from style.css for a 2048px wide window
+HEADER_BOX = (44, 32, 1836, 916)
+TOP_SCROLLBAR_BOX = (1908, 32, 96, 1830)
+SPACER_BOX = (44, 980, 1836, 882)
+FOOTER_BOX = (44, 1894, 1962, 122)
+FOOTER_TEXT = (53, 1903)  # inside the border and the 0.25em margin
+LABELS_BOX = (1389, 1903, 480, 104)
+BODY_SCROLLBAR_X = (1908, 2004)
+TABLE_X = (44, 1880)  # beside the scrollbar float
+
+# Font sizes in px: body is 4em, cells .8em of it, dates 1.1em, the footer 24pt
+FOOTER_SIZE = 32
+CELL_SIZE = 51.2
+DATE_SIZE = 70.4
+END_TIME_SIZE = CELL_SIZE * .8
+DETAILS_SIZE = CELL_SIZE * .5
+CELL_PADDING = 1  # the UA's td padding
+DATE_PADDING = DATE_SIZE * .2
+TIME_WIDTH = CELL_SIZE * 6.5 + 2 * CELL_PADDING
+SUMMARY_INDENT = CELL_SIZE * 2
+
+# line-height: normal of Noto Sans JP, (ascender + descender) / em
+LINE_HEIGHT = 1.448
+# Upper bounds on advances, in em, for estimating how many lines a summary wraps to
+NARROW_ADVANCE = .65
+WIDE_ADVANCE = 1.0
+HEIGHT_SLACK = 128
+HEIGHT_STEP = 256
+
+FOOTER_LINES = ("/vrg/ Calendar - rentry.co/vrgeventcalendar",
+                "Developed by Asylum, ComfyPillow, Mona, and Sleepy")
+# Where a line may break: at spaces, and around any CJK character
+CJK = '\u3000-\u30ff\u3400-\u9fff\uf900-\ufaff\uff00-\uffef'
+BREAKS = re.compile(f'[{CJK}]|[^\\s{CJK}]+|\\s+')
+
+
+class GlyphCache:
+    """Alpha masks and advances of one face at one size, rasterized on first use"""
+
+    def __init__(self, font):
+        self.font = font
+        ascent, descent = font.getmetrics()
+        self.ascent = ascent
+        self.line_height = ascent + descent  # line-height: normal
+        self._glyphs = {}
+
+    def glyph(self, ch):
+        """(alpha, x offset, y offset from the ascent line, advance)"""
+        glyph = self._glyphs.get(ch)
+        if glyph is None:
+            left, top, right, bottom = self.font.getbbox(ch, anchor='la')
+            alpha = np.zeros((0, 0), dtype=np.float32)
+            if right > left and bottom > top:
+                mask = Image.new('L', (right - left, bottom - top))
+                ImageDraw.Draw(mask).text((-left, -top), ch, font=self.font, fill=255, anchor='la')
+                alpha = np.asarray(mask, dtype=np.float32)[:, :, None] / 255
+            glyph = self._glyphs[ch] = (alpha, left, top, self.font.getlength(ch))
+        return glyph
+
+    def width(self, text):
+        return sum(self.glyph(ch)[3] for ch in text)
+
+    def wrap(self, text, width):
+        """Lines of text broken greedily to fit width, as a browser would with white-space: normal"""
+        lines, line, line_width = [], '', 0
+        for token in BREAKS.findall(text):
+            if token.isspace():
+                token = ' '
+            token_width = self.width(token)
+            if line and line_width + token_width > width and not token.isspace():
+                lines.append(line.rstrip())
+                line, line_width = '', 0
+            if not line and token.isspace():
+                continue
+            line += token
+            line_width += token_width
+        lines.append(line.rstrip())
+        return lines
+
+    def draw(self, canvas, x, baseline, text, color):
+        """Blend text onto canvas with its baseline at 'baseline'; returns the pen position after it"""
+        color = np.array(color, dtype=np.float32)
+        top = baseline - self.ascent
+        for ch in text:
+            alpha, left, dy, advance = self.glyph(ch)
+            x0, y0 = int(round(x + left)), int(round(top + dy))
+            h, w = alpha.shape[:2]
+            x1, y1 = min(x0 + w, canvas.shape[1]), min(y0 + h, canvas.shape[0])
+            if w and h and x0 >= 0 and y0 >= 0 and x1 > x0 and y1 > y0:
+                a = alpha[:y1 - y0, :x1 - x0]
+                region = canvas[y0:y1, x0:x1]
+                region[:] = region * (1 - a) + color * a
+            x += advance
+        return x
+
+
+def fill(canvas, box, color):
+    """Fill a box given in fractional pixels, rounding its edges so that adjacent boxes meet"""
+    x, y, w, h = box
+    x0, y0, x1, y1 = round(x), round(y), round(x + w), round(y + h)
+    region = canvas[max(y0, 0):max(y1, 0), max(x0, 0):max(x1, 0)]
+    if region.size:
+        # Broadcasting one uint8 row is many times faster than filling from a tuple
+        region[:] = np.full((1, region.shape[1], 3), color, dtype=np.uint8)
+
+
+class NativeRenderer:
+    """
+    Draws the pages generate_calendars describes: rows as given by
+    OccurrenceTable.project or project_events, labels as (timezone, now).
+    The chrome is drawn once and copied under every page.
+    """
+
+    def __init__(self, banner_path, descriptions=False, max_detail_lines=4, chars_per_detail_line=80):
+        if ImageFont is None:
+            raise ImportError("The native renderer needs Pillow: pip install pillow")
+        self.descriptions = descriptions
+        self.max_detail_lines = max_detail_lines
+        self.chars_per_detail_line = chars_per_detail_line
+        self._faces = {}
+        self._wrapped = {}
+        self.banner = cv2.imread(banner_path, cv2.IMREAD_COLOR)
+        self._chrome = None
+
+    def face(self, size, bold=False):
+        key = (size, bold)
+        if key not in self._faces:
+            font_path = f"{FONT_DIR}/{FACES[1 if bold else 0][1]}"
+            try:
+                font = ImageFont.truetype(font_path, size)
+            except OSError:
+                print(f"Font missing at {font_path}, using Pillow's default")
+                font = ImageFont.load_default(size)
+            self._faces[key] = GlyphCache(font)
+        return self._faces[key]
+
+    def chrome(self):
+        """The top CHROME_HEIGHT rows of a page, with the labels left blank"""
+        if self._chrome is None:
+            canvas = np.empty((CHROME_HEIGHT, PAGE_SIZE[0], 3), dtype=np.uint8)
+            fill(canvas, (0, 0, PAGE_SIZE[0], CHROME_HEIGHT), BACKGROUND)
+            fill(canvas, HEADER_BOX, HEADER)
+            x, y, w, h = HEADER_BOX
+            if self.banner is not None:
+                canvas[y:y + h, x:x + w] = scale_to_cover(self.banner, w, h)
+            fill(canvas, TOP_SCROLLBAR_BOX, SCROLLBAR)
+            fill(canvas, SPACER_BOX, SPACER)
+            self.draw_footer(canvas, FOOTER_BOX[1])
+            face = self.face(FOOTER_SIZE)
+            for i, line in enumerate(FOOTER_LINES):
+                face.draw(canvas, FOOTER_TEXT[0], FOOTER_TEXT[1] + i * face.line_height + face.ascent, line, DARK_TEXT)
+            self._chrome = canvas
+        return self._chrome
+
+    def draw_footer(self, canvas, top):
+        x, _, w, h = FOOTER_BOX
+        fill(canvas, (x, top, w, h), FOOTER_BORDER)
+        fill(canvas, (x + 1, top + 1, w - 2, h - 2), SCROLLBAR)
+
+    def draw_labels(self, canvas, top, labels):
+        """Right-aligned in the .labels box, whose top is at 'top'"""
+        x, _, w, h = LABELS_BOX
+        fill(canvas, (x, top, w, h), SCROLLBAR)
+        face = self.face(FOOTER_SIZE)
+        for i, line in enumerate((f"UTC{labels[0]}", f"Generated {labels[1]}")):
+            face.draw(canvas, x + w - face.width(line), top + i * face.line_height + face.ascent, line, DARK_TEXT)
+
+    def body(self, rows, height=BODY_HEIGHT):
+        """The calendar below the chrome"""
+        canvas = np.empty((height, PAGE_SIZE[0], 3), dtype=np.uint8)
+        background = np.full((1, PAGE_SIZE[0], 3), BACKGROUND, dtype=np.uint8)
+        background[:, BODY_SCROLLBAR_X[0]:BODY_SCROLLBAR_X[1]] = SCROLLBAR
+        canvas[:] = background
+        table_x, table_end = TABLE_X
+        y = 0.0
+        day = None
+        for e, e_date, start_hm, end_hm in rows:
+            if y >= height:
+                break
+            if e_date != day:
+                day = e_date
+                face = self.face(round(DATE_SIZE))
+                row_height = face.line_height + 2 * DATE_PADDING
+                fill(canvas, (table_x, y, table_end - table_x, row_height), DATE_BACKGROUND)
+                text_x = table_x + (table_end - table_x - face.width(e_date)) / 2
+                face.draw(canvas, text_x, round(y + DATE_PADDING + face.ascent), e_date, LIGHT_TEXT)
+                y += row_height
+            y += self.draw_event(canvas, y, e, start_hm, end_hm)
+        return canvas
+
+    def summary_lines(self, e):
+        """[(text, face)] of an event's summary cell, wrapped once per distinct event"""
+        key = (e['summary'], e['desc'], e['allday'])
+        lines = self._wrapped.get(key)
+        if lines is None:
+            face = self.face(round(CELL_SIZE), bold=e['allday'])
+            width = TABLE_X[1] - TABLE_X[0] - TIME_WIDTH - SUMMARY_INDENT - CELL_PADDING
+            lines = [(line, face) for line in face.wrap(e['summary'], width)]
+            if self.descriptions and e['desc'] and len(e['desc']) > 4:
+                details = self.face(round(DETAILS_SIZE))
+                desc_str = truncate_description(e['desc'], self.max_detail_lines, self.chars_per_detail_line)
+                for desc_line in desc_str.split('\n'):
+                    lines.extend((line, details) for line in details.wrap(desc_line, width))
+            self._wrapped[key] = lines
+        return lines
+
+    def draw_event(self, canvas, y, e, start_hm, end_hm):
+        """One time/summary row with its top at y; returns its height"""
+        table_x, table_end = TABLE_X
+        cell = self.face(round(CELL_SIZE))
+        lines = self.summary_lines(e)
+        # Every line keeps the cell's line height, even the smaller details (line-height: 0 on the span)
+        row_height = len(lines) * cell.line_height + 2 * CELL_PADDING
+        fill(canvas, (table_x, y, TIME_WIDTH, row_height), TIME_BACKGROUND)
+        fill(canvas, (table_x + TIME_WIDTH, y, table_end - table_x - TIME_WIDTH, row_height), SPACER)
+
+        baseline = round(y + CELL_PADDING + cell.ascent)
+        if not e['allday']:
+            small = self.face(round(END_TIME_SIZE))
+            head = f"{start_hm} ~ " if end_hm else start_hm
+            width = cell.width(head) + (small.width(end_hm) if end_hm else 0)
+            x = cell.draw(canvas, table_x + (TIME_WIDTH - width) / 2, baseline, head, LIGHT_TEXT)
+            if end_hm:
+                small.draw(canvas, x, baseline, end_hm, LIGHT_TEXT)
+
+        text_x = table_x + TIME_WIDTH + SUMMARY_INDENT
+        for i, (line, face) in enumerate(lines):
+            face.draw(canvas, text_x, baseline + i * cell.line_height, line, DARK_TEXT)
+        return row_height
+
+    def page(self, labels, rows, height=PAGE_SIZE[1]):
+        """A PAGE_SIZE page, or its top 'height' rows, as Firefox would screenshot it"""
+        canvas = np.empty((height, PAGE_SIZE[0], 3), dtype=np.uint8)
+        canvas[:CHROME_HEIGHT] = self.chrome()
+        self.draw_labels(canvas, LABELS_BOX[1], labels)
+        canvas[CHROME_HEIGHT:] = self.body(rows, height - CHROME_HEIGHT)
+        return canvas
+
+    def label_strip(self, labels):
+        """Footers stacked like compose.label_strip_html lays them out"""
+        canvas = np.empty((LABEL_TILE_HEIGHT * len(labels), PAGE_SIZE[0], 3), dtype=np.uint8)
+        fill(canvas, (0, 0, PAGE_SIZE[0], canvas.shape[0]), BACKGROUND)
+        for i, tile_labels in enumerate(labels):
+            top = i * LABEL_TILE_HEIGHT
+            self.draw_footer(canvas, top)
+            self.draw_labels(canvas, top + LABELS_BOX[1] - FOOTER_BOX[1], tile_labels)
+        return canvas
+
+
+def _line_count(text, size, width):
+    advance = sum(NARROW_ADVANCE if ord(ch) < 0x2E80 else WIDE_ADVANCE for ch in text) * size
+    # Breaking at spaces leaves some of every line empty
+    return max(1, -(-int(advance * 1.15) // int(width)))
+
+
+def estimate_height(rows, descriptions=False, max_detail_lines=4, chars_per_detail_line=80):
+    """
+    Page height, in whole HEIGHT_STEPs, that the rows surely fit in when laid
+    out by style.css. Errs on the tall side; capped at the full page.
+    """
+    width = TABLE_X[1] - TABLE_X[0] - TIME_WIDTH - SUMMARY_INDENT - CELL_PADDING
+    cell_line = CELL_SIZE * LINE_HEIGHT
+    height = CHROME_HEIGHT + HEIGHT_SLACK
+    day = None
+    for e, e_date, _, _ in rows:
+        if e_date != day:
+            day = e_date
+            height += DATE_SIZE * LINE_HEIGHT + 2 * DATE_PADDING
+        lines = _line_count(e['summary'], CELL_SIZE, width)
+        if descriptions and e['desc'] and len(e['desc']) > 4:
+            desc_str = truncate_description(e['desc'], max_detail_lines, chars_per_detail_line)
+            lines += sum(_line_count(line, DETAILS_SIZE, width) for line in desc_str.split('\n'))
+        height += lines * cell_line + 2 * CELL_PADDING
+        if height >= PAGE_SIZE[1]:
+            return PAGE_SIZE[1]
+    return min(PAGE_SIZE[1], -(-int(height) // HEIGHT_STEP) * HEIGHT_STEP)
+
+
+def compare_renders(native, reference, tolerance=32):
+    """(mean absolute difference, share of pixels off by more than tolerance, diff image) of two BGR images"""
+    h, w = min(native.shape[0], reference.shape[0]), min(native.shape[1], reference.shape[1])
+    diff = cv2.absdiff(native[:h, :w], reference[:h, :w])
+    off = diff.max(axis=2) > tolerance
+    return float(diff.mean()), float(off.mean()), diff
+
+
+if __name__ == '__main__':
+    # Render the first timezone natively from calendar.ical, and compare it with a Firefox screenshot if given
+    import sys
+    import time
+    from datetime import datetime, timedelta, timezone
+
+    from ics import expand_events, read_event_defs
+    from occurrences import OccurrenceTable
+
+    with open("calendar.ical", "r", encoding="utf-8") as f:
+        event_defs = read_event_defs(f.read())
+    now = datetime.now(timezone.utc)
+    window_end = now + timedelta(days=14)
+    table = OccurrenceTable(expand_events(event_defs, now - timedelta(days=1), window_end + timedelta(days=1)))
+    rows = table.project(0, now, window_end)
+
+    renderer = NativeRenderer("html-resources/banner/current.png")
+    start = time.time()
+    renderer.page(("+0", now.strftime('%b %d @ %H:%M')), rows)
+    first = time.time()
+    native = renderer.page(("+0", now.strftime('%b %d @ %H:%M')), rows)
+    print(f"First page {first - start:.3f}s, then {time.time() - first:.3f}s per page")
+    cv2.imwrite("output/native.png", native)
+    if len(sys.argv) > 1:
+        mean_diff, off_share, diff = compare_renders(native, cv2.imread(sys.argv[1]))
+        cv2.imwrite("output/native-diff.png", diff)
+        print(f"Mean difference {mean_diff:.2f}, {off_share:.2%} of pixels off; see output/native-diff.png")
@@ -0,0 +1,177 @@
+"""
+Folding and labelling the screenshots across processes
+
+Decoding a 2048x8192 PNG and encoding the 4096x4096 result each keep a core
+busy for a good fraction of a second, so pages are reshaped by a pool of
+worker processes. Each decodes its own screenshots, folds them into one
+square buffer it keeps for every page it handles, and writes the PNGs itself;
+no frame is ever pickled. Images several pages need (the chrome, label strips
+and atlases) are decoded once, by a worker, into shared memory that the others
+map by name. Only one atlas is held at a time, so memory stays at about one
+atlas plus a page and a buffer per worker.
+
+Smaller variants of each output, for less capable players, are scaled down from
+the same folded buffer and written beside it with their size as a suffix.
+"""
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from changes import signature
+from compose import PAGE_SIZE, atlas_panel, composite_fold, fold_page, paste_labels
+
+FOLD_SIZE = 2 * PAGE_SIZE[0]  # side of a folded page
+_attached = {}  # shared memory name -> (SharedMemory, array), mapped once per process
+_folded = None  # this process's output buffer
+
+
+def png_shape(path):
+    """(height, width, 3) from a PNG's header without decoding it, or None if unreadable"""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(24)
+    except OSError:
+        return None
+    if len(header) < 24 or header[:8] != b'\x89PNG\r\n\x1a\n':
+        return None
+    width, height = struct.unpack('>II', header[16:24])
+    return height, width, 3
+
+
+def sized_path(path, size):
+    """Path of the size x size variant of an output: path itself at FOLD_SIZE, else suffixed _<size>"""
+    if size == FOLD_SIZE:
+        return path
+    stem, extension = os.path.splitext(path)
+    return f"{stem}_{size}{extension}"
+
+
+def downscaled(folded, sizes):
+    """(size, image) for each of sizes, largest first, each scaled down from the one before by area"""
+    image = folded
+    for size in sorted(sizes, reverse=True):
+        if size != image.shape[0]:
+            image = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+        yield size, image
+
+
+def attach(spec):
+    """The array a (name, shape) spec of shared memory refers to, mapped on first use"""
+    name, shape = spec
+    if name not in _attached:
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = (shm, np.ndarray(shape, dtype=np.uint8, buffer=shm.buf))
+    return _attached[name][1]
+
+
+def detach(name):
+    """Unmap shared memory mapped by attach; no views of it may be left"""
+    shm, _ = _attached.pop(name, (None, None))
+    if shm is not None:
+        shm.close()
+
+
+def _decode_into(path, spec):
+    image = cv2.imread(path)
+    target = attach(spec)
+    decoded = image is not None and image.shape == target.shape
+    if decoded:
+        target[:] = image
+    del target
+    detach(spec[0])
+    return decoded
+
+
+def _reshape(source, chrome, outputs, sizes=(FOLD_SIZE,), volatile=()):
+    """
+    Fold one screenshot and write it once per output, labelled as that output says,
+    at each of sizes (see sized_path), taking the changes.signature of each with
+    the volatile regions left out.
+    source is a screenshot path, or (atlas spec, index, columns,
+    height) of a panel; chrome is the spec of the chrome to stack it under, or None.
+    outputs is [(path, (strip spec, tile index) or None)], the page's own first.
+    Returns ([(path written, its signature)], [messages]).
+    """
+    global _folded
+    if isinstance(source, str):
+        image = cv2.imread(source)
+        if image is None or image.size == 0:
+            return [], [f"Image did not exist at path {source}"]
+    else:
+        atlas, index, columns, height = source
+        image = atlas_panel(attach(atlas), index, columns, height)
+
+    if chrome is not None:
+        _folded = composite_fold(attach(chrome), image, _folded)
+    else:
+        _folded = fold_page(image, _folded)
+    del image
+    if not isinstance(source, str):
+        # Unmapped after every panel, so a released atlas is really freed
+        detach(source[0][0])
+
+    written, messages = [], []
+    for out_path, tile in outputs:
+        # Each output's labels cover the last's entirely, so one buffer serves them all
+        if tile is not None:
+            strip, index = tile
+            if not paste_labels(_folded, attach(strip), index):
+                messages.append(f"Could not label {os.path.basename(out_path)}")
+                continue
+        for size, image in downscaled(_folded, sizes):
+            cv2.imwrite(sized_path(out_path, size), image)
+            written.append((sized_path(out_path, size), signature(image, volatile, FOLD_SIZE)))
+    return written, messages
+
+
+class Reshaper:
+    """
+    A pool of workers folding screenshots, and the shared images they read.
+    workers=1 runs everything in this process.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.pool = None
+        self.shared = {}  # path -> SharedMemory
+
+    def __enter__(self):
+        if self.workers == 1:
+            self.pool = ThreadPoolExecutor(max_workers=1)
+        else:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.shutdown()
+        for path in list(self.shared):
+            self.release(path)
+
+    def share(self, path):
+        """Spec of the image at path decoded into shared memory by a worker, or None if unreadable"""
+        shape = png_shape(path)
+        if shape is None:
+            return None
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        spec = (shm.name, shape)
+        if not self.pool.submit(_decode_into, path, spec).result():
+            shm.close()
+            shm.unlink()
+            return None
+        self.shared[path] = shm
+        return spec
+
+    def release(self, path):
+        shm = self.shared.pop(path, None)
+        if shm is not None:
+            detach(shm.name)
+            shm.close()
+            shm.unlink()
+
+    def reshape(self, source, chrome, outputs, sizes=(FOLD_SIZE,), volatile=()):
+        """Future of _reshape in a worker"""
+        return self.pool.submit(_reshape, source, chrome, outputs, sizes, volatile)
@@ -0,0 +1,154 @@
+"""
+Vectorized expansion of the simple recurrence rules that make up most of the feed
+
+Plain FREQ=DAILY/WEEKLY (optionally with INTERVAL, BYDAY, WKST) and FREQ=MONTHLY
+rules are expanded with numpy day arithmetic instead of rrule's per-period
+iteration. Anything else returns None so the caller can fall back to rrule.
+Results mirror rrule_patched exactly, including its UNTIL handling.
+
+Run this module directly to compare it with rrule over calendar.ical; tests/test_rrule_fast.py
+does the same over random rules.
+"""
+import calendar
+from datetime import datetime
+
+import numpy as np
+from dateutil import parser
+
+SIMPLE_FREQS = ('DAILY', 'WEEKLY', 'MONTHLY')
+SIMPLE_PARTS = {'FREQ', 'INTERVAL', 'COUNT', 'UNTIL', 'WKST', 'BYDAY'}
+WEEKDAYS = {"MO": 0, "TU": 1, "WE": 2, "TH": 3, "FR": 4, "SA": 5, "SU": 6}
+# 1970-01-01, which was a Thursday
+EPOCH_ORDINAL = 719163
+EPOCH_WEEKDAY = 3
+# Slack in days around the window, enough for any difference between the window's tz and DTSTART's
+SLACK_DAYS = 2
+
+
+def is_simple(parts):
+    if parts.get('FREQ') not in SIMPLE_FREQS or not SIMPLE_PARTS.issuperset(parts):
+        return False
+    if 'BYDAY' in parts:
+        # Ordinals like -1FR need rrule, as does BYDAY filtering MONTHLY
+        if parts['FREQ'] == 'MONTHLY' or not all(d in WEEKDAYS for d in parts['BYDAY'].split(',')):
+            return False
+    return True
+
+
+def _weekday(days):
+    return (days + EPOCH_WEEKDAY) % 7
+
+
+def _period_range(first, lo, hi, step, counted):
+    """Indexes of the periods between lo and hi, or from the very first one when COUNT needs them all"""
+    k0 = 0 if counted else max(0, (lo - first) // step)
+    k1 = max(k0, (hi - first) // step + 1)
+    return np.arange(k0, k1, dtype=np.int64)
+
+
+def _candidate_days(parts, start_day, lo, hi, counted):
+    """Sorted day numbers (days since epoch) that the rule produces, before COUNT/UNTIL"""
+    freq = parts['FREQ']
+    interval = int(parts.get('INTERVAL') or 1)
+    byday = [WEEKDAYS[d] for d in parts['BYDAY'].split(',')] if 'BYDAY' in parts else None
+
+    if freq == 'DAILY':
+        days = start_day + interval * _period_range(start_day, lo, hi, interval, counted)
+        if byday is not None:
+            days = days[np.isin(_weekday(days), byday)]
+        return days
+
+    if freq == 'WEEKLY':
+        wkst = WEEKDAYS[parts['WKST']] if 'WKST' in parts else calendar.firstweekday()
+        if byday is None:
+            byday = [int(_weekday(start_day))]
+        week_start = start_day - (int(_weekday(start_day)) - wkst) % 7
+        offsets = np.array(sorted({(d - wkst) % 7 for d in byday}), dtype=np.int64)
+        weeks = week_start + 7 * interval * _period_range(week_start, lo, hi, 7 * interval, counted)
+        days = (weeks[:, None] + offsets[None, :]).ravel()
+        # The first week only runs from DTSTART onwards
+        return days[days >= start_day]
+
+    # MONTHLY, on DTSTART's day of the month; months without that day are skipped
+    start_month = np.datetime64(start_day, 'D').astype('datetime64[M]').astype(np.int64)
+    lo_month = np.datetime64(lo, 'D').astype('datetime64[M]').astype(np.int64)
+    hi_month = np.datetime64(hi, 'D').astype('datetime64[M]').astype(np.int64)
+    months = start_month + interval * _period_range(start_month, lo_month, hi_month, interval, counted)
+    month_start = months.astype('datetime64[M]').astype('datetime64[D]')
+    month_len = ((months + 1).astype('datetime64[M]').astype('datetime64[D]') - month_start).astype(np.int64)
+    mday = np.datetime64(start_day, 'D').item().day
+    return month_start[month_len >= mday].astype(np.int64) + (mday - 1)
+
+
+def expand_simple(parts, start, exclusions, after, before):
+    """
+    Occurrences of a split RRULE from DTSTART 'start' between after and before (inclusive),
+    minus the exclusions, or None if the rule isn't simple enough for this path.
+    Equivalent to rruleset.between(after, before, inc=True) with those exdates.
+    """
+    if start.tzinfo is None or not is_simple(parts):
+        return None
+    start = start.replace(microsecond=0)
+    tzinfo = start.tzinfo
+
+    until = None
+    if 'UNTIL' in parts:
+        try:
+            until = parser.parse(parts['UNTIL'])
+        except ValueError:
+            return None
+        # rrule_patched keeps UNTIL's wall clock and relabels it with DTSTART's tz
+        until = until.replace(tzinfo=tzinfo)
+    count = int(parts['COUNT']) if 'COUNT' in parts else None
+
+    start_day = start.date().toordinal() - EPOCH_ORDINAL
+    lo = after.astimezone(tzinfo).date().toordinal() - EPOCH_ORDINAL - SLACK_DAYS
+    hi = before.astimezone(tzinfo).date().toordinal() - EPOCH_ORDINAL + SLACK_DAYS
+    if until is not None:
+        hi = min(hi, until.date().toordinal() - EPOCH_ORDINAL)
+
+    days = _candidate_days(parts, start_day, lo, hi, count is not None)
+    if count is not None:
+        days = days[:count]
+    days = days[(days >= lo) & (days <= hi)]
+
+    excluded = set(exclusions)
+    time = start.timetz()
+    dates = []
+    for day in days.astype('datetime64[D]').tolist():
+        d = datetime.combine(day, time)
+        if until is not None and d > until:
+            break
+        if after <= d <= before and d not in excluded:
+            dates.append(d)
+    return dates
+
+
+if __name__ == '__main__':
+    # Differential check against rrule over every simple rule in the cached calendar
+    from datetime import timedelta, timezone
+    from ics import read_event_defs, split_rule, date_to_datetime, exclusion_datetimes
+    from rrule_patched import rruleset, rrulestr
+
+    with open("calendar.ical", "r", encoding="utf-8") as f:
+        event_defs = read_event_defs(f.read())
+    now = datetime.now(timezone.utc)
+    checked = 0
+    for defn in event_defs:
+        if not defn['rrule'] or not is_simple(split_rule(defn['rrule'])):
+            continue
+        dtstart = date_to_datetime(defn['start'], timezone.utc) if defn['allday'] else defn['start']
+        exdates = exclusion_datetimes(defn['exdates'], dtstart, timezone.utc)
+        for shift in range(-400, 400, 50):
+            w_start = now + timedelta(days=shift)
+            w_end = w_start + timedelta(days=14)
+            rules = rruleset()
+            rules.rrule(rrulestr(defn['rrule'], dtstart=dtstart))
+            for xdt in exdates:
+                rules.exdate(xdt)
+            expected = rules.between(w_start, w_end, inc=True)
+            got = expand_simple(split_rule(defn['rrule']), dtstart, exdates, w_start, w_end)
+            if got != expected:
+                print(f"Mismatch for {defn['summary']!r} {defn['rrule']}:\n  rrule: {expected}\n  fast:  {got}")
+            checked += 1
+    print(f"Checked {checked} windows")
@@ -0,0 +1,100 @@
+"""
+What a run has done so far, for carrying on after a failure
+
+A run is the pages of one generate_calendars call taken through STAGES. Each
+stage records here, per page, that it has finished with it and which files it
+left for the next stage to read, so a run that died in ffmpeg or on the way to
+Drive can be resumed without rendering again. Nothing is deleted along the way;
+the last stage, cleanup, removes the screenshots and square images at the end.
+The manifest is kept as JSON under output/run, beside the pickled pages, which
+hold every output's signature and so are only written again once a stage is over.
+"""
+import json
+import os
+
+from cache import read_pickle, replacing, write_pickle
+
+STAGES = ['calendars', 'render', 'reshape', 'encode', 'upload', 'cleanup']
+RUN_DIR = "output/run"
+
+
+class Run:
+    """
+    The manifest of one run: {page name: {stage: [files it left]}}, and its pages.
+    Runs without a directory are only kept in memory.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.manifest = {}
+        self.pages = None
+
+    def load(self):
+        """Read back the last run saved in the directory; False if there is none"""
+        if self.directory is None:
+            return False
+        pages = read_pickle(self.directory + "/pages.pickle")
+        try:
+            with open(self.directory + "/manifest.json", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if pages is None:
+            return False
+        self.manifest, self.pages = manifest, pages
+        return True
+
+    def start(self, pages):
+        """Begin a new run of these pages, forgetting the last"""
+        self.pages = pages
+        self.manifest = {page['name']: {'calendars': []} for page in pages}
+        self.save_pages()
+        self.save()
+
+    def save_pages(self):
+        if self.directory is not None:
+            write_pickle(self.directory + "/pages.pickle", self.pages)
+
+    def save(self):
+        """Write the manifest"""
+        if self.directory is None:
+            return
+        with replacing(self.directory + "/manifest.json") as tmp_path, open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=1)
+
+    def done(self, stage, name):
+        return stage in self.manifest.get(name, {})
+
+    def ready(self, stage, name):
+        """Whether the stage before this one is done for name, and this one isn't"""
+        previous = STAGES[STAGES.index(stage) - 1]
+        return self.done(previous, name) and not self.done(stage, name)
+
+    def paths(self, stage, name):
+        """Files the stage left for name"""
+        return self.manifest.get(name, {}).get(stage, [])
+
+    def complete(self, stage, name, paths=()):
+        """Record that the stage is done for name, leaving paths"""
+        self.manifest.setdefault(name, {})[stage] = list(paths)
+        self.save()
+
+    def forget(self, stage, name=None):
+        """Undo the stage, and every one after it, for name or else all pages"""
+        later = STAGES[STAGES.index(stage):]
+        for stages in (self.manifest.values() if name is None else [self.manifest.get(name, {})]):
+            for undone in later:
+                stages.pop(undone, None)
+        self.save()
+
+    def revalidate(self):
+        """
+        Undo, for every page, each finished stage whose files have since gone
+        missing while the next stage still needs them, along with every stage
+        after it, and so on back
+        """
+        for name, stages in self.manifest.items():
+            for previous, stage in reversed(list(zip(STAGES, STAGES[1:]))):
+                if stage not in stages and previous in stages and not all(map(os.path.exists, stages[previous])):
+                    self.forget(previous, name)
+        self.save()
@@ -0,0 +1,138 @@
+"""
+Compiled fragments of the calendar HTML
+
+Every occurrence of an event renders the same summary cell in every zone, so
+the escaping and description truncation are done once per distinct event and
+kept; date headers and time cells come from lookup tables filled on first use.
+A document is then one join of ready-made strings.
+"""
+import html
+from string import Template
+
+HEAD_TEMPLATE = "html-resources/template/head.html"
+TAIL_TEMPLATE = "html-resources/template/tail.html"
+BODY_TEMPLATE = "html-resources/template/body.html"
+
+TABLE_OPEN = "<div class=\"calendar\"><table>\n"
+TABLE_CLOSE = "</table>\n</div>\n"
+DATE_ROW = "\t<tr><td colspan=\"2\" class=\"date\">%s</td></tr>\n"
+ALLDAY_CELL = "\t<tr><td class=\"starttime\">&nbsp;</td>"
+SPAN_CELL = "\t<tr><td class=\"starttime\">%s ~ <span class=\"endtime\">%s</span></td>"
+START_CELL = "\t<tr><td class=\"starttime\">%s</td>"
+DETAILS_TRUNCATED = "...\n[Description Truncated; More info on online calendar]"
+
+
+def truncate_description(desc, max_lines, chars_per_line):
+    """desc without blank lines, cut to max_lines or max_lines * chars_per_line characters"""
+    desc_array = list(filter(None, desc.split('\n')))
+    trunc = False
+    if len(desc_array) > max_lines:
+        desc_array = desc_array[:max_lines]
+        trunc = True
+    desc_str = '\n'.join(desc_array)
+    if len(desc_str) > (chars_per_line * max_lines):
+        desc_str = desc_str[:chars_per_line * max_lines]
+        desc_str = desc_str[:desc_str.rfind(" ")]
+        trunc = True
+    if trunc:
+        desc_str = desc_str + DETAILS_TRUNCATED
+    return desc_str
+
+
+class CalendarTemplate:
+    """
+    head.html and tail.html around a table of rows, as given by
+    OccurrenceTable.project or project_events. Keep one for all the zones of a
+    run, so each fragment is built once across them.
+    """
+
+    def __init__(self, descriptions=False, max_detail_lines=4, chars_per_detail_line=80,
+                 banner="../../html-resources/banner/current.png"):
+        with open(HEAD_TEMPLATE, "r", encoding="utf-8") as f:
+            self.head_template = Template(f.read())
+        with open(TAIL_TEMPLATE, "r", encoding="utf-8") as f:
+            self.tail = f.read()
+        with open(BODY_TEMPLATE, "r", encoding="utf-8") as f:
+            self.body_head = f.read()
+        self.banner = banner
+        self.descriptions = descriptions
+        self.max_detail_lines = max_detail_lines
+        self.chars_per_detail_line = chars_per_detail_line
+        self._date_rows = {}
+        self._time_cells = {}
+        self._event_cells = {}
+
+    def date_row(self, e_date):
+        row = self._date_rows.get(e_date)
+        if row is None:
+            row = self._date_rows[e_date] = DATE_ROW % e_date
+        return row
+
+    def time_cell(self, allday, start_hm, end_hm):
+        key = (allday, start_hm, end_hm)
+        cell = self._time_cells.get(key)
+        if cell is None:
+            if allday:
+                cell = ALLDAY_CELL
+            elif end_hm:
+                cell = SPAN_CELL % (start_hm, end_hm)
+            else:
+                cell = START_CELL % start_hm
+            self._time_cells[key] = cell
+        return cell
+
+    def event_cell(self, e):
+        """The summary cell and the rest of the row, escaped and truncated once per distinct event"""
+        key = (e['summary'], e['desc'], e['allday'])
+        cell = self._event_cells.get(key)
+        if cell is None:
+            cell = f"<td class=\"summary{' allday' if e['allday'] else ''}\">{html.escape(e['summary'])}"
+            if self.descriptions and e['desc'] and len(e['desc']) > 4:
+                desc_str = truncate_description(e['desc'], self.max_detail_lines, self.chars_per_detail_line)
+                cell += f"<br /><span class=\"details\">{html.escape(desc_str)}</span>"
+            cell += "</td></tr>\n"
+            self._event_cells[key] = cell
+        return cell
+
+    def table(self, rows):
+        """The calendar's HTML: a header row for each new date, then one row per event"""
+        parts = [TABLE_OPEN]
+        day = None
+        for e, e_date, start_hm, end_hm in rows:
+            if e_date != day:
+                parts.append(self.date_row(e_date))
+                day = e_date
+            parts.append(self.time_cell(e['allday'], start_hm, end_hm))
+            parts.append(self.event_cell(e))
+        parts.append(TABLE_CLOSE)
+        return ''.join(parts)
+
+    def document(self, labels, table):
+        timezone, now = labels
+        return ''.join((self.head_template.substitute(timezone=timezone, now=now, banner=self.banner),
+                        table, self.tail))
+
+    def chrome_document(self):
+        """The banner, spacer and footer with an empty calendar; its labels are pasted over"""
+        return self.document(('', ''), TABLE_OPEN + TABLE_CLOSE)
+
+    def body_document(self, table):
+        """Only the calendar, laid out as it is below the chrome"""
+        return ''.join((self.body_head, table, self.tail))
+
+
+def atlas_document(documents, height=None):
+    """
+    Several documents from CalendarTemplate as fixed-size panels of one page,
+    left to right and wrapping at the window's width. They must share one <head>.
+    height, if given, overrides every panel's height in style.css.
+    """
+    head, rest = documents[0].split('<body', 1)
+    parts = [head, '<body class="atlas">\n']
+    style = f' style="height: {height}px"' if height else ''
+    for document in documents:
+        body_tag, rest = document.split('<body', 1)[1].split('>', 1)
+        body = rest.rsplit('</body>', 1)[0]
+        parts.append(f'<div class="panel{" body-only" if "body-only" in body_tag else ""}"{style}>{body}</div>\n')
+    parts.append('</body>\n</html>')
+    return ''.join(parts)
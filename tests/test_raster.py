@@ -0,0 +1,96 @@
+"""NativeRenderer's pages against validate.py and estimate_height, and optionally against Firefox"""
+import os
+import shutil
+import subprocess
+from datetime import datetime, timedelta, timezone
+
+import cv2
+import pytest
+
+pytest.importorskip("PIL")
+
+from compose import BODY_HEIGHT, CHROME_HEIGHT, bottom_is_blank
+from occurrences import project_events
+from raster import NativeRenderer, compare_renders, estimate_height
+from templates import CalendarTemplate
+from validate import chrome_problem, page_problem, strip_problem
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BANNER = "html-resources/banner/current.png"
+LABELS = ("+9", "Oct 19 @ 22:07")
+SUMMARIES = ["Weekly meetup", "A rather long event name that wraps onto a second line of the summary cell, "
+             "at least in a 2048px wide window", "日本語のイベント名、折り返しのあるとても長いタイトルのテストです。" * 2,
+             "Short"]
+
+
+@pytest.fixture(autouse=True)
+def in_repo(monkeypatch):
+    # Fonts, the banner and the templates are found relative to the repo
+    monkeypatch.chdir(ROOT)
+
+
+def rows(count):
+    """Rows of count events, a few a day, some all-day, some wrapping"""
+    start = datetime(2026, 10, 19, 9, tzinfo=timezone.utc)
+    events = []
+    for i in range(count):
+        startdt = start + timedelta(hours=7 * i)
+        events.append({'startdt': startdt, 'enddt': startdt + timedelta(hours=2), 'allday': i % 5 == 4,
+                       'recurring': False, 'summary': SUMMARIES[i % len(SUMMARIES)], 'desc': None, 'loc': None})
+    return project_events(events, timezone(timedelta(hours=9)))
+
+
+@pytest.fixture(scope="module")
+def renderer():
+    return NativeRenderer(os.path.join(ROOT, BANNER))
+
+
+@pytest.mark.parametrize("count", [1, 8, 30])
+def test_fitted_page_is_valid_and_whole(renderer, count):
+    page_rows = rows(count)
+    height = estimate_height(page_rows)
+    page = renderer.page(LABELS, page_rows, height)
+    assert page_problem(page) is None
+    assert bottom_is_blank(page)
+
+
+def test_body_is_valid(renderer):
+    assert page_problem(renderer.body(rows(8)), chrome=False) is None
+    assert page_problem(renderer.body([], BODY_HEIGHT), chrome=False, events=False) is None
+
+
+def test_chrome_is_valid(renderer):
+    chrome = renderer.chrome()
+    assert chrome.shape[0] == CHROME_HEIGHT
+    assert chrome_problem(chrome) is None
+
+
+def test_label_strip_is_valid(renderer):
+    labels = [(f"{offset:+d}", "Oct 19 @ 13:07") for offset in range(-12, 15)]
+    assert strip_problem(renderer.label_strip(labels), len(labels)) is None
+
+
+@pytest.mark.skipif(shutil.which("firefox") is None, reason="needs Firefox")
+def test_matches_firefox(renderer, tmp_path):
+    from fonts import write_font_faces
+
+    page_rows = rows(8)
+    banner = os.path.relpath(BANNER, "output/html").replace(os.sep, '/')
+    template = CalendarTemplate(banner=banner)
+    document = template.document(LABELS, template.table(page_rows))
+    write_font_faces([document, ' '.join(LABELS)])
+    html_path = os.path.abspath("output/html/test-native.html")
+    with open(html_path, "w", encoding="utf-8") as f:
+        f.write(document)
+    shot_path = str(tmp_path / "firefox.png")
+    try:
+        subprocess.run(["firefox", "--headless", "--no-remote", "--profile", str(tmp_path), "--screenshot", shot_path,
+                        f"file:///{html_path}", "--window-size=2048,8192"], timeout=300,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    finally:
+        os.remove(html_path)
+    reference = cv2.imread(shot_path)
+    assert reference is not None, "Firefox took no screenshot"
+    mean_diff, off_share, _ = compare_renders(renderer.page(LABELS, page_rows), reference)
+    # Close, not pixel-exact: glyphs are rasterized and positioned a little differently
+    assert mean_diff < 8 and off_share < .05, (mean_diff, off_share)
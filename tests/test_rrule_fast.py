@@ -0,0 +1,70 @@
+"""expand_simple against rruleset.between, over random simple rules"""
+import random
+from itertools import islice
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from dateutil import tz
+
+from ics import split_rule
+from rrule_fast import WEEKDAYS, expand_simple, is_simple
+from rrule_patched import rruleset, rrulestr
+
+ZONES = [timezone.utc, timezone(timedelta(hours=9)), tz.gettz('Europe/Berlin'), tz.gettz('America/New_York'),
+         tz.gettz('Australia/Sydney')]
+CASES = 600
+
+
+def random_rule(rng, start):
+    freq = rng.choice(['DAILY', 'WEEKLY', 'MONTHLY'])
+    parts = [f'FREQ={freq}']
+    if rng.random() < .5:
+        parts.append(f'INTERVAL={rng.randint(1, 4)}')
+    if freq != 'MONTHLY' and rng.random() < .5:
+        parts.append('BYDAY=' + ','.join(rng.sample(list(WEEKDAYS), rng.randint(1, 4))))
+    if freq == 'WEEKLY' and rng.random() < .5:
+        parts.append('WKST=' + rng.choice(list(WEEKDAYS)))
+    ending = rng.random()
+    if ending < .3:
+        parts.append(f'COUNT={rng.randint(1, 60)}')
+    elif ending < .45:
+        parts.append('UNTIL=' + (start + timedelta(days=rng.randint(0, 400))).strftime('%Y%m%d'))
+    elif ending < .6:
+        parts.append('UNTIL=' + (start + timedelta(days=rng.randint(0, 400))).strftime('%Y%m%dT%H%M%SZ'))
+    return ';'.join(parts)
+
+
+def random_case(seed):
+    rng = random.Random(seed)
+    zone = rng.choice(ZONES)
+    # Wall clock times around the DST changes at 02:00-03:00 included
+    start = datetime(2025, rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23), rng.choice([0, 30]),
+                     tzinfo=zone)
+    rule = random_rule(rng, start)
+    occurrences = list(islice(rrulestr(rule, dtstart=start), 200))
+    exdates = rng.sample(occurrences, min(len(occurrences), rng.randint(0, 3)))
+    # Half the windows hold DTSTART's first weeks, where WKST and the first period matter
+    shift = rng.randint(-10, 3) if rng.random() < .5 else rng.randint(-30, 500)
+    window_start = (start + timedelta(days=shift, hours=rng.randint(0, 23))).astimezone(timezone.utc)
+    return rule, start, exdates, window_start, window_start + timedelta(days=14)
+
+
+@pytest.mark.parametrize('seed', range(CASES))
+def test_matches_rrule(seed):
+    rule, start, exdates, window_start, window_end = random_case(seed)
+    parts = split_rule(rule)
+    assert is_simple(parts)
+    rules = rruleset()
+    rules.rrule(rrulestr(rule, dtstart=start))
+    for exdate in exdates:
+        rules.exdate(exdate)
+    assert expand_simple(parts, start, exdates, window_start, window_end) == \
+        rules.between(window_start, window_end, inc=True), (rule, start, exdates, window_start)
+
+
+def test_declines_what_it_cant_expand():
+    start = datetime(2025, 3, 1, 10, tzinfo=timezone.utc)
+    assert expand_simple(split_rule('FREQ=MONTHLY;BYDAY=-1FR'), start, [], start, start + timedelta(days=60)) is None
+    assert expand_simple(split_rule('FREQ=YEARLY'), start, [], start, start + timedelta(days=60)) is None
+    assert expand_simple(split_rule('FREQ=DAILY'), start.replace(tzinfo=None), [], start,
+                         start + timedelta(days=60)) is None
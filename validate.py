@@ -0,0 +1,82 @@
+"""
+Quick checks that a screenshot shows the page it was asked for
+
+Firefox sometimes screenshots a page before it has finished loading: blank,
+without its stylesheet, before the banner decodes, or with the text still
+hidden while the fonts load. Each check looks for the colours style.css
+guarantees in the region it paints, on a strided view of every SAMPLE-th row
+and column, so validating a page takes milliseconds and copies nothing.
+Each returns None for a good screenshot, else a short description of the fault.
+"""
+import numpy as np
+
+from compose import CHROME_HEIGHT, footer_edges
+from raster import (BACKGROUND, BODY_SCROLLBAR_X, DATE_BACKGROUND, HEADER_BOX, LIGHT_TEXT, SCROLLBAR, TABLE_X)
+
+SAMPLE = 4
+TOLERANCE = 4  # per channel, for colours Firefox blends into its neighbours
+MIN_SCROLLBAR_SHARE = .9  # of the rows, the scrollbar runs the page's height
+FOOTER_SEARCH = 256  # rows above the end of the chrome holding its footer
+
+
+def _matches(view, colour):
+    """Mask of the pixels of view within TOLERANCE of colour"""
+    return np.all(np.abs(view.astype(np.int16) - colour) <= TOLERANCE, axis=-1)
+
+
+def _blank(view):
+    return view.size == 0 or bool(np.all(view == view[0, 0]))
+
+
+def chrome_problem(chrome):
+    """Faults of the top CHROME_HEIGHT rows of a page: banner, spacer and footer"""
+    view = chrome[:CHROME_HEIGHT:SAMPLE, ::SAMPLE]
+    if _blank(view):
+        return "is blank"
+    x, y, w, h = HEADER_BOX
+    if _blank(chrome[y:y + h:SAMPLE, x:x + w:SAMPLE]):
+        return "has no banner"
+    if not footer_edges(chrome[CHROME_HEIGHT - FOOTER_SEARCH:CHROME_HEIGHT]):
+        return "has no footer"
+    return None
+
+
+def body_problem(body, events=True):
+    """Faults of the calendar below the chrome; events says whether it should show any"""
+    view = body[::SAMPLE, ::SAMPLE]
+    if _blank(view):
+        return "is blank"
+    if not np.all(_matches(view[:, :TABLE_X[0] // SAMPLE], BACKGROUND)):
+        return "has no page background"
+    scrollbar = _matches(view[:, (BODY_SCROLLBAR_X[0] + BODY_SCROLLBAR_X[1]) // 2 // SAMPLE], SCROLLBAR)
+    if np.count_nonzero(scrollbar) < MIN_SCROLLBAR_SHARE * len(scrollbar):
+        return "has no scrollbar"
+    if not events:
+        return None
+    # Rows where a date header spans the table, its light text somewhere along them
+    date_rows = _matches(view[:, (TABLE_X[0] + 8) // SAMPLE], DATE_BACKGROUND)
+    if not date_rows.any():
+        return "has no calendar"
+    # Thin glyph strokes fall between sampled pixels, so this looks at full resolution
+    if not _matches(body[np.flatnonzero(date_rows) * SAMPLE, TABLE_X[0]:TABLE_X[1]], LIGHT_TEXT).any():
+        return "has no text"
+    return None
+
+
+def page_problem(image, chrome=True, events=True):
+    """Faults of a page screenshot, with or without its chrome on top"""
+    if image is None or image.size == 0:
+        return "is missing"
+    if chrome:
+        return chrome_problem(image) or body_problem(image[CHROME_HEIGHT:], events)
+    return body_problem(image, events)
+
+
+def strip_problem(strip, tiles):
+    """Faults of a label strip that should hold 'tiles' footers"""
+    if strip is None or strip.size == 0:
+        return "is missing"
+    found = len(footer_edges(strip))
+    if found != tiles:
+        return f"has {found} of {tiles} footers"
+    return None